@@ -0,0 +1,66 @@
+"""
+Compare the diff algorithms in ugit.diffalgo against difflib on large,
+repetitive inputs such as lockfiles and JSON fixtures.
+
+Usage: python benchmarks/diff_benchmark.py [lines]
+"""
+
+import json
+import random
+import sys
+import time
+
+from ugit import diffalgo
+
+
+def lockfile(lines: int, rng: random.Random) -> list[str]:
+    """
+    Lockfile-like text: many near identical blocks with repeated lines
+    """
+    out = []
+    for i in range(lines // 5):
+        out.append(f'"package-{i}":')
+        out.append(f'  version "{rng.randrange(10)}.{rng.randrange(10)}.0"')
+        out.append("  dependencies:")
+        out.append('    "left-pad" "^1.0.0"')
+        out.append("")
+    return out
+
+
+def json_fixture(lines: int, rng: random.Random) -> list[str]:
+    records = [
+        {"id": i, "active": rng.random() < 0.5, "tags": ["a", "b"]}
+        for i in range(lines // 9)
+    ]
+    return json.dumps(records, indent=2).splitlines()
+
+
+def mutate(lines: list[str], rng: random.Random, edits: int) -> list[str]:
+    result = list(lines)
+    for _ in range(edits):
+        pos = rng.randrange(len(result))
+        result[pos : pos + rng.randrange(4)] = [f"edited {rng.random()}"]
+    return result
+
+
+def main() -> None:
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    rng = random.Random(0)
+    inputs = {
+        "lockfile": lockfile(lines, rng),
+        "json": json_fixture(lines, rng),
+    }
+
+    print(f"{'input':<10}{'algorithm':<12}{'seconds':>10}{'changed lines':>15}")
+    for name, a in inputs.items():
+        b = mutate(a, rng, edits=200)
+        for algorithm in diffalgo.ALGORITHMS:
+            start = time.perf_counter()
+            opcodes = diffalgo.get_opcodes(a, b, algorithm)
+            elapsed = time.perf_counter() - start
+            changed = sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag != "equal")
+            print(f"{name:<10}{algorithm:<12}{elapsed:>10.3f}{changed:>15}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,23 +3,90 @@ import itertools
 import string
 import operator
 import os
+import socket
+import time
 from sys import stdout
 from turtle import up, update
 from typing import NamedTuple
 from collections import deque
+import heapq
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
+from . import bloom
 from . import data
 from . import diff
+from . import graph
+from . import pack
+
+# Threads used to hash files when scanning the working tree
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Threads used to write files on checkout
+CHECKOUT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# add: files at least this big are streamed on threads, smaller ones are
+# hashed in batches, on processes once there are enough of them
+ADD_WORKERS = os.cpu_count() or 1
+ADD_LARGE_FILE = 1024 * 1024
+ADD_BATCH_SIZE = 64
+ADD_PROCESS_MIN_FILES = 512
+
+# Parsed structures, bounded by number of entries
+COMMIT_CACHE_ENTRIES = 100_000
+TREE_CACHE_ENTRIES = 1_000_000
+
+_commit_cache = data.LRUCache("commits", COMMIT_CACHE_ENTRIES, sizeof=lambda _: 1)
+_tree_cache = data.LRUCache("trees", TREE_CACHE_ENTRIES)
+
+# Commits with a generation divisible by this get a reachability bitmap,
+# along with every ref tip
+BITMAP_INTERVAL = 100
+
+# Unreachable objects younger than this are kept by gc, they may belong to
+# a command that is still running
+GC_GRACE_SECONDS = 14 * 24 * 60 * 60
+
+# Abbreviated OIDs are printed with at least DEFAULT_ABBREV characters and
+# accepted from MIN_ABBREV characters on
+DEFAULT_ABBREV = 7
+MIN_ABBREV = 4
+
+# Graph nodes computed for commits missing from the commit-graph file
+_node_cache = data.LRUCache("commit-nodes", COMMIT_CACHE_ENTRIES, sizeof=lambda _: 1)
+
+
+class Signature(NamedTuple):
+    """
+    Who wrote or committed a commit and when: "Name <email>", seconds since
+    the epoch and the UTC offset as written (e.g. "+0200").
+    """
+
+    identity: str
+    timestamp: int
+    offset: str
+
+    def __str__(self) -> str:
+        return f"{self.identity} {self.timestamp} {self.offset}"
 
 
 class Commit(NamedTuple):
     """
     Light-weight structure describing a commit object and its metadata.
+    Commits written before ugit recorded authors have no signatures.
     """
 
     tree: str
     parents: list[str]
     message: str
+    author: Signature | None = None
+    committer: Signature | None = None
+
+    @property
+    def timestamp(self) -> int:
+        """
+        Commit time, 0 for commits without a committer
+        """
+        return self.committer.timestamp if self.committer else 0
 
 
 def init() -> None:
@@ -31,29 +98,104 @@ def init() -> None:
     data.update_ref("HEAD", data.RefValue(symbolic=True, value=master_location))
 
 
-def read_tree_merged(t_base, t_head, t_other, update_working: bool = False):
+def read_tree_merged(t_base, t_head, t_other, update_working: bool = False) -> int:
     """
     Write the result of a three-way tree merge into the working directory.
+    Returns the number of files touched in the working directory.
     """
     with data.get_index() as index:
-        index.clear()
-        index.update(
-            diff.merge_trees(get_tree(t_base), get_tree(t_head), get_tree(t_other))
-        )
+        merged, taken = merge_tree_oids(t_base, t_head, t_other)
+        old_index = _replace_index(index, merged)
+        for dir_path, tree_oid in taken.items():
+            _prime_cache_tree(index, tree_oid, dir_path)
 
         if update_working:
-            _checkout_index(index)
+            return _checkout_index(old_index, index)
+    return 0
 
 
-def get_merge_base(oid1: str, oid2: str):
+def merge_tree_oids(
+    t_base: str | None, t_head: str | None, t_other: str | None
+) -> tuple[dict[str, str], dict[str, str]]:
     """
-    Find the common ancestor shared by the two commit OIDs.
+    Three-way merge of tree objects.
+    Subtrees and blobs changed on one side only are taken from that side by
+    OID without being read, and only blobs changed on both sides are merged
+    with diff3.
+
+    Args: base, head and other tree OIDs
+    Returns: merged path -> blob OID, directories taken whole -> tree OID
     """
-    parents1 = iter_commits_and_parents({oid1})
+    merged: dict[str, str] = {}
+    taken: dict[str, str] = {}
+    conflicts: list[tuple[str, str | None, str, str]] = []
+
+    def take(tree_oid, path):
+        if tree_oid:
+            merged.update(get_tree(tree_oid, os.path.join(path, "")))
+            taken[path] = tree_oid
+
+    def walk(b, h, o, path):
+        if h == o or b == o:
+            return take(h, path)
+        if b == h:
+            return take(o, path)
+
+        entries = [_node_entries(node) for node in (b, h, o)]
+        for name in sorted(set().union(*entries)):
+            child_path = os.path.join(path, name)
+            found = [level.get(name, (None, None)) for level in entries]
+
+            subtrees = [value if type_ == "tree" else None for type_, value in found]
+            if any(subtrees):
+                walk(*subtrees, child_path)
+
+            bb, bh, bo = [value if type_ == "blob" else None for type_, value in found]
+            if bh == bo or bb == bo:
+                result = bh
+            elif bb == bh:
+                result = bo
+            elif bh is None or bo is None:
+                # Modified on one side, deleted on the other: keep the change
+                result = bh or bo
+            else:
+                conflicts.append((child_path, bb, bh, bo))
+                continue
+            if result is not None:
+                merged[child_path] = result
 
-    for oid in iter_commits_and_parents({oid2}):
-        if oid in parents1:
+    walk(t_base or None, t_head or None, t_other or None, "")
+    merged.update(diff.merge_conflicting_blobs(conflicts))
+    return merged, taken
+
+
+def get_merge_base(oid1: str, oid2: str) -> str | None:
+    """
+    Find the best common ancestor shared by the two commit OIDs.
+    Both histories are walked together, highest generation first, so the
+    first commit reached from both sides has no other common ancestor
+    descending from it.
+
+    Args: commit OIDs (str)
+    Returns: merge base OID (str) or None if the histories are unrelated
+    """
+    flags = {oid1: 1}
+    flags[oid2] = flags.get(oid2, 0) | 2
+    queue = [(-get_commit_node(oid).generation, oid) for oid in flags]
+    heapq.heapify(queue)
+
+    while queue:
+        _, oid = heapq.heappop(queue)
+        if flags[oid] == 3:
             return oid
+        # Every child has a higher generation and was popped already, so
+        # the flags of this commit are final
+        for parent in get_commit_node(oid).parents:
+            if parent not in flags:
+                flags[parent] = 0
+                heapq.heappush(queue, (-get_commit_node(parent).generation, parent))
+            flags[parent] |= flags[oid]
+    return None
 
 
 def merge(other: str):
@@ -64,39 +206,69 @@ def merge(other: str):
     assert HEAD
     merge_base = get_merge_base(other, HEAD)
     assert merge_base
+    _ = update_commit_graph([HEAD, other])
     c_other = get_commit(other)
 
     if merge_base == HEAD:
-        read_tree(c_other.tree, True)
+        touched = read_tree(c_other.tree, True)
         data.update_ref("HEAD", data.RefValue(symbolic=False, value=other))
-        print("Fast-forward merge, no need to commit")
+        print(f"Fast-forward merge, no need to commit ({touched} files updated)")
         return
 
     data.update_ref("MERGE_HEAD", data.RefValue(symbolic=False, value=other))
 
     c_base = get_commit(merge_base)
     c_HEAD = get_commit(HEAD)
-    read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree, True)
-    print("Merged in working tree\nPlease commit")
+    touched = read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree, True)
+    print(f"Merged in working tree ({touched} files updated)\nPlease commit")
 
 
 def get_working_tree() -> dict[str, str]:
     """
     Walk the working directory and return blob IDs for every tracked file.
+    Files whose stat data matches the index reuse the staged OID, the rest
+    are hashed in parallel without writing any objects.
     """
     result: dict[str, str] = dict()
+    to_hash: list[tuple[str, os.stat_result]] = []
+
+    with data.get_index() as index:
+        for path, st in _iter_working_files():
+            if data.stat_matches(index, path, st):
+                result[path] = index[path].oid
+            else:
+                to_hash.append((path, st))
+
+        if not to_hash:
+            return result
+
+        with ThreadPoolExecutor(SCAN_WORKERS) as executor:
+            oids = executor.map(data.hash_file, (path for path, _ in to_hash))
+            for (path, st), oid in zip(to_hash, oids):
+                result[path] = oid
+                entry = index.get(path)
+                # Refresh the stat data of files that turned out unchanged
+                if entry is not None and entry.oid == oid:
+                    index[path] = data.index_entry(path, oid, st)
 
-    for root, _, filenames in os.walk("."):
-        for filename in filenames:
-            relative_path = os.path.join(root, filename)
-            path = os.path.relpath(relative_path)
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, "rb") as f:
-                result[path] = data.hash_object(f.read())
     return result
 
 
+def _iter_working_files(directory: str = "."):
+    """
+    Yield (path, stat) for every file in the working directory
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            path = os.path.relpath(entry.path)
+            if is_ignored(path):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_working_files(entry.path)
+            elif entry.is_file():
+                yield path, entry.stat()
+
+
 def reset(oid: str) -> None:
     """
     Update HEAD to point directly at the provided commit OID.
@@ -168,16 +340,16 @@ def create_tag(name: str, oid: str) -> None:
     data.update_ref(ref_location, data.RefValue(symbolic=False, value=oid))
 
 
-def checkout(name: str) -> None:
+def checkout(name: str) -> int:
     """
     Switch repository state to state at COMMIT OID
 
     Args: OID (str)
-    Returns: None
+    Returns: Number of files touched (int)
     """
     oid: str = get_oid(name)
     commit = get_commit(oid)
-    read_tree(commit.tree, True)
+    touched = read_tree(commit.tree, True)
     if is_branch(name):
         ref_location: str = os.path.join("refs", "heads", name)
         head = data.RefValue(symbolic=True, value=ref_location)
@@ -185,6 +357,7 @@ def checkout(name: str) -> None:
         head = data.RefValue(symbolic=False, value=oid)
 
     data.update_ref("HEAD", head, deref=False)
+    return touched
 
 
 def commit(message: str) -> str:
@@ -192,8 +365,12 @@ def commit(message: str) -> str:
     create a commit Object with the following information
         Tree TreeOID
          Parent ParentOID <Optional>
+         Author Signature
+         Committer Signature
         \\n
         message
+    Signatures come from the UGIT_AUTHOR_* and UGIT_COMMITTER_* environment
+    variables (NAME, EMAIL and DATE as "<seconds> <offset>") when set
 
     Args: message(str)
     Returns: Commit OID (str)
@@ -209,17 +386,42 @@ def commit(message: str) -> str:
         commitObject += f"parent {MERGE_HEAD}\n"
         data.delete_ref("MERGE_HEAD", deref=False)
 
+    commitObject += f"author {_signature('author')}\n"
+    commitObject += f"committer {_signature('committer')}\n"
     commitObject += "\n"
     commitObject += f"{message}\n"
 
     oid: str = data.hash_object(commitObject.encode(), "commit")
     data.update_ref("HEAD", data.RefValue(symbolic=False, value=oid))
+    _ = update_commit_graph([oid])
 
     _ = stdout.flush()
     _ = stdout.write(commitObject)
     return oid
 
 
+def _signature(role: str) -> Signature:
+    """
+    Signature for the AUTHOR or COMMITTER header, the current user and time
+    unless overridden by the environment
+    """
+    prefix = f"UGIT_{role.upper()}_"
+    name = os.environ.get(prefix + "NAME") or os.environ.get("USER") or "ugit"
+    email = os.environ.get(prefix + "EMAIL") or f"{name}@{socket.gethostname()}"
+
+    date = os.environ.get(prefix + "DATE")
+    if date:
+        timestamp, _, offset = date.partition(" ")
+        return Signature(f"{name} <{email}>", int(timestamp), offset or "+0000")
+
+    now = int(time.time())
+    minutes = time.localtime(now).tm_gmtoff // 60
+    offset = (
+        f"{'-' if minutes < 0 else '+'}{abs(minutes) // 60:02}{abs(minutes) % 60:02}"
+    )
+    return Signature(f"{name} <{email}>", now, offset)
+
+
 def write_tree(directory: str = ".") -> str:
     """
     Recursively go through all the files and folders and hash them with the correct types.
@@ -228,59 +430,145 @@ def write_tree(directory: str = ".") -> str:
     Args: directory = '.' (str)
     Returns: OID (str)
     """
-    index_as_tree = {}
     with data.get_index() as index:
-        for path, oid in index.items():
-            path = os.path.split(path)
-            dir_path, filename = path[:-1], path[-1]
+        index_as_tree = {}
+        for path, entry in index.items():
+            *dir_path, filename = path.split(os.sep)
 
             current = index_as_tree
             for dirname in dir_path:
                 current = current.setdefault(dirname, {})
-            current[filename] = oid
-
-    def write_tree_recursive(tree_dict):
-        entries = []
-        for name, value in tree_dict.items():
-            if type(value) is dict:
-                type_ = "tree"
-                oid = write_tree_recursive(value)
-            else:
-                type_ = "blob"
-                oid = value
+            current[filename] = entry.oid
+
+        def write_tree_recursive(tree_dict, dir_path):
+            # Directories without changed entries since the last write reuse
+            # their tree OID from the cache tree
+            cached = index.cache_tree.get(dir_path)
+            if cached is not None:
+                return cached
+
+            entries = []
+            for name, value in tree_dict.items():
+                if type(value) is dict:
+                    type_ = "tree"
+                    oid = write_tree_recursive(value, os.path.join(dir_path, name))
+                else:
+                    type_ = "blob"
+                    oid = value
 
-            entries.append((name, oid, type_))
+                entries.append((name, oid, type_))
 
-        tree = "".join(
-            f"{type_} {oid} {name}\n" for name, oid, type_ in sorted(entries)
-        )
-        return data.hash_object(tree.encode(), "tree")
+            tree = "".join(
+                f"{type_} {oid} {name}\n" for name, oid, type_ in sorted(entries)
+            )
+            oid = data.hash_object(tree.encode(), "tree")
+            index.cache_tree[dir_path] = oid
+            return oid
 
-    return write_tree_recursive(index_as_tree)
+        return write_tree_recursive(index_as_tree, "")
 
 
-def read_tree(tree_oid: str, update_working: bool = False) -> None:
+def read_tree(tree_oid: str, update_working: bool = False) -> int:
     """
-    Replace current directory with the files from a tree OID
-    Empties current directory first and then puts every file back in it's position
+    Replace the index with the files from a tree OID
+    With update_working, only the files that differ from the old index are
+    deleted, created or overwritten in the working directory
 
-    Args: Tree OID (str)
-    Returns: None
+    Args: Tree OID (str), update_working (bool)
+    Returns: Number of files touched (int)
     """
     with data.get_index() as index:
-        index.clear()
-        index.update(get_tree(tree_oid))
+        old_index = _replace_index(index, get_tree(tree_oid))
+        _prime_cache_tree(index, tree_oid, "")
 
         if update_working:
-            _checkout_index(index)
+            return _checkout_index(old_index, index)
+    return 0
+
+
+def _replace_index(index, tree: dict[str, str]):
+    """
+    Replace the index entries with the path -> OID mapping of TREE.
+    Only entries that change are touched, so unchanged entries keep their
+    stat data and unchanged directories keep their cache tree.
+
+    Returns: the old index
+    """
+    old_index = dict(index)
+    for path in old_index:
+        if path not in tree:
+            del index[path]
+    for path, oid in tree.items():
+        entry = old_index.get(path)
+        if entry is None or entry.oid != oid:
+            index[path] = data.IndexEntry(oid)
+    return old_index
+
+
+def _prime_cache_tree(index, tree_oid: str, dir_path: str) -> None:
+    """
+    Record the OIDs of TREE_OID and its subtrees in the cache tree,
+    since the index now holds exactly their contents
+    """
+    entries = list(_iter_tree_entries(tree_oid))
+    if any(not name for _, _, name in entries):
+        # Trees written by older versions nest root files under an empty
+        # name, let the next write_tree rebuild them
+        return
+    index.cache_tree[dir_path] = tree_oid
+    for type_, oid, name in entries:
+        if type_ == "tree":
+            _prime_cache_tree(index, oid, os.path.join(dir_path, name))
+
 
+def _checkout_index(old_index, index) -> int:
+    """
+    Update the working directory from OLD_INDEX to INDEX.
+    Files are only removed or written when their OID differs (or they are
+    missing), and writes are spread over a thread pool so blobs are read
+    while other files are being written.
+
+    Returns: Number of files touched (int)
+    """
+    removed = [path for path in old_index if path not in index]
+    to_write = [
+        path
+        for path, entry in index.items()
+        if path not in old_index
+        or old_index[path].oid != entry.oid
+        or not os.path.isfile(path)
+    ]
+    _ = data.prefetch_objects(index[path].oid for path in to_write)
+
+    for path in removed:
+        if os.path.isfile(path):
+            os.remove(path)
+        _remove_empty_parents(path)
 
-def _checkout_index(index):
-    _empty_current_directory()
-    for path, oid in index.items():
+    def write_file(path):
         os.makedirs(os.path.dirname(os.path.join("./", path)), exist_ok=True)
         with open(path, "wb") as f:
-            _ = f.write(data.get_object(oid, "blob"))
+            data.stream_object(index[path].oid, f, "blob")
+        return os.stat(path)
+
+    with ThreadPoolExecutor(CHECKOUT_WORKERS) as executor:
+        for path, st in zip(to_write, executor.map(write_file, to_write)):
+            index[path] = data.index_entry(path, index[path].oid, st)
+
+    return len(removed) + len(to_write)
+
+
+def _remove_empty_parents(path: str) -> None:
+    """
+    Remove the now empty directories above a deleted file
+    """
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
 
 
 def get_tree(oid: str, base_path: str = "") -> dict[str, str]:
@@ -308,24 +596,103 @@ def get_tree(oid: str, base_path: str = "") -> dict[str, str]:
     return result
 
 
-def _empty_current_directory() -> None:
+class _DictTree:
     """
-    Helper function to erase all files from current directory
+    Directory view of a flat path -> OID dict, so it can be walked alongside
+    tree objects. OID is the directory's tree OID when known (from the
+    index cache tree), otherwise None.
     """
-    for root, dirnames, filenames in os.walk(".", topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(os.path.join(root, filename))
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path)
-        for dirname in dirnames:
-            path = os.path.relpath(os.path.join(root, dirname))
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                pass
+
+    def __init__(self, oid: str | None = None):
+        self.oid = oid
+        self.children: dict[str, "str | _DictTree"] = {}
+
+
+def iter_tree_changes(*trees):
+    """
+    Walk two or three trees together and yield (path, *blob OIDs) for
+    every path whose blob differs between them, in path order.
+    Each tree is a tree OID, a path -> OID dict, a data.Index (whose cache
+    tree is used) or None. Subtrees with the same known OID everywhere are
+    skipped without being read.
+
+    Args: trees
+    Yields: (path, *oids)
+    """
+    yield from _walk_trees([_tree_node(tree) for tree in trees], "")
+
+
+def iter_staged_changes(tree_oid: str | None = None):
+    """
+    Changes between a tree (HEAD's by default) and the index
+    """
+    if tree_oid is None:
+        head = data.get_ref("HEAD").value
+        tree_oid = head and get_commit(head).tree
+    with data.get_index() as index:
+        yield from iter_tree_changes(tree_oid, index)
+
+
+def _tree_node(tree):
+    if tree is None or isinstance(tree, str):
+        return tree or None
+
+    cache_tree = tree.cache_tree if isinstance(tree, data.Index) else {}
+    root = _DictTree(cache_tree.get(""))
+    for path, value in tree.items():
+        oid = value.oid if isinstance(value, data.IndexEntry) else value
+        *dir_path, name = path.split(os.sep)
+        node = root
+        for i, dirname in enumerate(dir_path):
+            child = node.children.get(dirname)
+            if not isinstance(child, _DictTree):
+                child = _DictTree(cache_tree.get(os.sep.join(dir_path[: i + 1])))
+                node.children[dirname] = child
+            node = child
+        node.children[name] = oid
+    return root
+
+
+def _node_entries(node) -> dict[str, tuple[str, object]]:
+    """
+    name -> (type, blob OID or subtree node) for one level of a tree node
+    """
+    if node is None:
+        return {}
+    if isinstance(node, _DictTree):
+        return {
+            name: ("tree" if isinstance(child, _DictTree) else "blob", child)
+            for name, child in node.children.items()
+        }
+
+    entries: dict[str, tuple[str, object]] = {}
+    for type_, oid, name in _iter_tree_entries(node):
+        if not name:
+            # Older trees nest root files under an empty name
+            entries.update(_node_entries(oid))
+        else:
+            entries[name] = (type_, oid)
+    return entries
+
+
+def _walk_trees(nodes, base_path: str):
+    entries = [_node_entries(node) for node in nodes]
+    for name in sorted(set().union(*entries)):
+        path = os.path.join(base_path, name)
+        found = [level.get(name, (None, None)) for level in entries]
+
+        subtrees = [value if type_ == "tree" else None for type_, value in found]
+        if any(subtree is not None for subtree in subtrees):
+            keys = [
+                subtree.oid if isinstance(subtree, _DictTree) else subtree
+                for subtree in subtrees
+            ]
+            if keys[0] is None or any(key != keys[0] for key in keys):
+                yield from _walk_trees(subtrees, path)
+
+        blobs = [value if type_ == "blob" else None for type_, value in found]
+        if any(blob != blobs[0] for blob in blobs):
+            yield (path, *blobs)
 
 
 def _iter_tree_entries(oid: str):
@@ -337,32 +704,234 @@ def _iter_tree_entries(oid: str):
     """
     if not oid:
         return
-    tree = data.get_object(oid, "tree")
-    for entry in tree.decode().splitlines():
-        type_, oid_, name = entry.split(" ", 2)
-        yield type_, oid_, name
+    entries = _tree_cache.get(oid)
+    if entries is None:
+        tree = data.get_object(oid, "tree")
+        entries = [tuple(entry.split(" ", 2)) for entry in tree.decode().splitlines()]
+        _tree_cache.put(oid, entries)
+    yield from entries
 
 
-def iter_objects_in_commit(oids):
-    visited = set()
+def find_missing_objects(wants, haves, blobs: bool = True) -> list[str]:
+    """
+    List the objects reachable from the WANTS commits but not from the HAVES
+    commits (haves missing from this repository are ignored), leaving out
+    blobs unless BLOBS is set.
+    Uses the reachability bitmaps of the largest pack that has any, walking
+    only the commits without a bitmap and the objects outside that pack.
+    Without bitmaps (or with BLOBS unset) it walks back from the wants only
+    as far as the history they share with the haves.
+
+    Args: commit OIDs, commit OIDs, blobs (bool)
+    Returns: list[OID]
+    """
+    wants = [oid for oid in wants if oid]
+    haves = [oid for oid in haves if oid and data.object_exists(oid)]
 
-    def iter_objects_in_tree(oid):
-        visited.add(oid)
-        yield oid
+    # Bitmaps don't record object types, so they can't leave blobs out
+    pack_ = data.get_largest_pack(with_bitmaps=True)
+    if pack_ is None or not blobs:
+        return _find_missing_by_walk(wants, haves, blobs)
+
+    want_bits, want_extra = _reachable_bitmap(pack_, wants, pack_.bitmaps)
+    have_bits, have_extra = _reachable_bitmap(pack_, haves, pack_.bitmaps)
+    missing = list(pack_.iter_bitmap_oids(want_bits & ~have_bits))
+    missing.extend(sorted(want_extra - have_extra))
+    return missing
+
+
+def _find_missing_by_walk(
+    wants: list[str], haves: list[str], blobs: bool = True
+) -> list[str]:
+    """
+    Walk both histories together, highest generation first, marking
+    everything behind a have as uninteresting, and stop once only
+    uninteresting commits are left. Trees and blobs are then listed for the
+    remaining commits, skipping everything in the trees of the uninteresting
+    commits they build on.
+    """
+    uninteresting = set(haves)
+    queue = [(-get_commit_node(oid).generation, oid) for oid in {*wants, *haves}]
+    heapq.heapify(queue)
+    queued = {oid for _, oid in queue}
+    commits: list[str] = []
+    edges = set(haves)
+
+    while any(oid not in uninteresting for _, oid in queue):
+        _, oid = heapq.heappop(queue)
+        parents = get_commit_node(oid).parents
+        if oid in uninteresting:
+            uninteresting.update(parents)
+        else:
+            commits.append(oid)
+        for parent in parents:
+            if parent not in queued:
+                queued.add(parent)
+                heapq.heappush(queue, (-get_commit_node(parent).generation, parent))
+
+    # Every commit is popped after all its children, so a commit's own mark is
+    # final when it is taken, but its parents' marks are only final now
+    edges.update(
+        parent
+        for oid in commits
+        for parent in get_commit_node(oid).parents
+        if parent in uninteresting
+    )
+
+    have_objects: set[str] = set()
+    for oid in edges:
+        _collect_tree_objects(get_commit_node(oid).tree, have_objects, blobs=blobs)
+
+    missing = []
+    for oid in commits:
+        missing.append(oid)
+        new_objects: set[str] = set()
+        tree = get_commit_node(oid).tree
+        _collect_tree_objects(tree, new_objects, have_objects, blobs)
+        missing.extend(new_objects)
+        have_objects |= new_objects
+    return missing
+
+
+def _collect_tree_objects(
+    tree_oid: str, found: set[str], skip=frozenset(), blobs: bool = True
+) -> None:
+    """
+    Add TREE_OID and everything below it (blobs only if BLOBS is set) to
+    FOUND, not descending into trees that are already in FOUND or SKIP
+    """
+    trees = [tree_oid]
+    while trees:
+        oid = trees.pop()
+        if oid in found or oid in skip:
+            continue
+        found.add(oid)
+        for type_, entry_oid, _ in _iter_tree_entries(oid):
+            if type_ == "tree":
+                trees.append(entry_oid)
+            elif blobs and entry_oid not in skip:
+                found.add(entry_oid)
+
+
+def gc(grace_seconds: float = GC_GRACE_SECONDS, repack: bool = False) -> int:
+    """
+    Delete objects that no ref, MERGE_HEAD or the index can reach and that
+    are older than GRACE_SECONDS, optionally packing what is left.
+    Surviving objects are written before anything is removed, so concurrent
+    readers always find them.
+
+    Args: grace_seconds (float), repack (bool)
+    Returns: Number of pruned loose objects (int)
+    """
+    reachable = get_reachable_objects()
+    expire_before = time.time() - grace_seconds
+    pruned = data.prune_objects(reachable, expire_before)
+    if repack:
+        _ = data.repack(reachable, expire_before)
+        _ = write_bitmaps()
+    return pruned
+
+
+def get_reachable_objects() -> set[str]:
+    """
+    Every object reachable from the refs (including HEAD and MERGE_HEAD)
+    and from the index, blobs and trees it has cached included
+
+    Args: None
+    Returns: set[OID]
+    """
+    reachable: set[str] = set()
+    tips = {ref.value for _, ref in data.iter_refs()}
+    for oid in iter_commits_and_parents(tips):
+        reachable.add(oid)
+        _collect_tree_objects(get_commit_node(oid).tree, reachable)
+
+    with data.get_index() as index:
+        reachable.update(entry.oid for entry in index.values())
+        for tree_oid in index.cache_tree.values():
+            _collect_tree_objects(tree_oid, reachable)
+    return reachable
+
+
+def write_bitmaps() -> int:
+    """
+    Write reachability bitmaps for the repository's largest pack: one for
+    every ref tip and every commit whose generation is a multiple of
+    BITMAP_INTERVAL. Commits reaching objects outside the pack are left out.
+
+    Args: None
+    Returns: Number of bitmaps written (int)
+    """
+    pack_ = data.get_largest_pack()
+    if pack_ is None:
+        return 0
+
+    tips = {ref.value for _, ref in data.iter_refs()}
+    selected = []
+    for oid in iter_commits_and_parents(tips):
+        node = get_commit_node(oid)
+        if oid in tips or node.generation % BITMAP_INTERVAL == 0:
+            selected.append((node.generation, oid))
+
+    # Oldest first, so every walk stops at the bitmaps already built
+    bitmaps: dict[str, int] = {}
+    for _, oid in sorted(selected):
+        bits, extra = _reachable_bitmap(pack_, [oid], bitmaps)
+        if not extra:
+            bitmaps[oid] = bits
+
+    pack.write_bitmaps(pack_, bitmaps)
+    return len(bitmaps)
+
+
+def _reachable_bitmap(pack_: pack.Pack, oids, bitmaps: dict[str, int]):
+    """
+    Objects reachable from the commit OIDS, as a bitmap over PACK_ positions
+    plus a set of objects that are not in the pack.
+    The walk takes the bitmap of any commit that has one instead of walking
+    past it, and stops at objects already marked.
+    """
+    size = (pack_.count + 7) // 8
+    bits = bytearray(size)
+    extra: set[str] = set()
+
+    def mark(oid: str) -> bool:
+        position = pack_.position(oid)
+        if position is None:
+            if oid in extra:
+                return False
+            extra.add(oid)
+            return True
+        byte, bit = divmod(position, 8)
+        if bits[byte] >> bit & 1:
+            return False
+        bits[byte] |= 1 << bit
+        return True
+
+    stack = list(oids)
+    while stack:
+        oid = stack.pop()
+        bitmap = bitmaps.get(oid)
+        if bitmap is not None:
+            bits[:] = (int.from_bytes(bits, "little") | bitmap).to_bytes(size, "little")
+            continue
+        if not mark(oid):
+            continue
 
-        for type_, oid, _ in _iter_tree_entries(oid):
-            if oid not in visited:
+        commit = get_commit(oid)
+        trees = [commit.tree]
+        while trees:
+            tree = trees.pop()
+            if not mark(tree):
+                continue
+            for type_, entry_oid, _ in _iter_tree_entries(tree):
                 if type_ == "tree":
-                    yield from iter_objects_in_tree(oid)
+                    trees.append(entry_oid)
                 else:
-                    visited.add(oid)
-                    yield oid
+                    _ = mark(entry_oid)
+        stack.extend(commit.parents)
 
-    for oid in iter_commits_and_parents(oids):
-        yield oid
-        commit = get_commit(oid)
-        if commit.tree not in visited:
-            yield from iter_objects_in_tree(commit.tree)
+    return int.from_bytes(bits, "little"), extra
 
 
 def get_commit(oid: str):
@@ -370,11 +939,16 @@ def get_commit(oid: str):
     Reads through commit Information and returns tree hash, parent hash and message
 
     Args: Commit OID (str)
-    Returns: Commit(Tree (str), parent (str), message (str))
+    Returns: Commit(Tree (str), parent (str), message (str), author, committer)
     """
+    cached = _commit_cache.get(oid)
+    if cached is not None:
+        return cached
+
     parent: list[str] = []
 
     tree: str = ""
+    signatures: dict[str, Signature] = {}
 
     commit: str = data.get_object(oid, "commit").decode()
     lines = iter(commit.splitlines())
@@ -384,11 +958,22 @@ def get_commit(oid: str):
             tree = value
         elif key == "parent":
             parent.append(value)
+        elif key in ("author", "committer"):
+            identity, timestamp, offset = value.rsplit(" ", 2)
+            signatures[key] = Signature(identity, int(timestamp), offset)
         else:
             assert False, f"Unknown field {key}"
 
     message = "\n".join(lines)
-    return Commit(tree=tree, parents=parent, message=message)
+    result = Commit(
+        tree=tree,
+        parents=parent,
+        message=message,
+        author=signatures.get("author"),
+        committer=signatures.get("committer"),
+    )
+    _commit_cache.put(oid, result)
+    return result
 
 
 def get_oid(name: str) -> str:
@@ -409,17 +994,41 @@ def get_oid(name: str) -> str:
     ]
 
     for ref in refs_to_try:
-        result: str | None = data.get_ref(ref, deref=False).value
-        if result is not None:
+        if data.get_ref(ref, deref=False).value:
+            result = data.get_ref(ref).value
+            if not result:
+                raise ValueError(f"{name} does not point to a commit yet")
             return result
 
     is_hex = all(c in string.hexdigits for c in name)
     if len(name) == 40 and is_hex:
         return name
 
+    if len(name) >= MIN_ABBREV and is_hex:
+        candidates = data.find_objects(name)
+        assert len(candidates) < 2, f"Ambiguous name {name}, candidates:\n" + "\n".join(
+            f"  {candidate}" for candidate in candidates
+        )
+        if candidates:
+            return candidates[0]
+
     assert False, f"Unknown name {name}"
 
 
+def abbreviate(oid: str, length: int = DEFAULT_ABBREV) -> str:
+    """
+    Shortest prefix of OID, at least LENGTH characters, that no other
+    stored object shares
+
+    Args: OID (str), length (int)
+    Returns: str
+    """
+    for other in data.find_objects(oid[:length]):
+        if other != oid:
+            length = max(length, len(os.path.commonprefix([oid, other])) + 1)
+    return oid[:length]
+
+
 def is_ignored(path: str) -> bool:
     """
     Helper function to check if a folder is ignored
@@ -452,39 +1061,299 @@ def iter_commits_and_parents(oids_set: set[str]):
         visited.add(oid)
         yield oid
 
-        parent = get_commit(oid)
+        parents = _get_parents(oid)
+
+        oids.extendleft(parents[:1])
+        oids.extend(parents[1:])
+
+
+def iter_commits(
+    oids, order: str = "date", since: int | None = None, until: int | None = None
+):
+    """
+    Walk the history of OIDS newest first with a priority queue. Commits are
+    read as they are reached, so a caller that stops early (log -n) only
+    pays for the commits it took plus the pending frontier.
+
+    "date" order pops the latest commit time first; "topo" order pops the
+    highest generation first, so no commit comes before its children.
+    Commits newer than UNTIL are walked but not yielded, and commits older
+    than SINCE end their line of history. Commits without timestamps count
+    as time 0.
+
+    Args: OIDs, order ("date" or "topo"), since and until (epoch seconds)
+    Yields: oid (str) <Generator>
+    """
+    pending: list[tuple[tuple[int, int], str]] = []
+    seen: set[str] = set()
+
+    def push(oid: str) -> None:
+        if not oid or oid in seen:
+            return
+        seen.add(oid)
+        timestamp = get_commit(oid).timestamp
+        generation = get_commit_node(oid).generation
+        key = (
+            (-generation, -timestamp) if order == "topo" else (-timestamp, -generation)
+        )
+        heapq.heappush(pending, (key, oid))
+
+    for oid in oids:
+        push(oid)
 
-        oids.extendleft(parent.parents[:1])
-        oids.extend(parent.parents[1:])
+    while pending:
+        _, oid = heapq.heappop(pending)
+        timestamp = get_commit(oid).timestamp
+        if since is not None and timestamp < since:
+            continue
+        for parent in _get_parents(oid):
+            push(parent)
+        if until is None or timestamp <= until:
+            yield oid
+
+
+def _get_parents(oid: str) -> list[str]:
+    """
+    Parents of one commit, from the commit graph when it has them.
+    Unlike get_commit_node this never looks at ancestors, so it works while
+    history is still being fetched.
+    """
+    node = _known_node(oid)
+    return node.parents if node is not None else get_commit(oid).parents
+
+
+def is_ancestor_of(commit: str, maybe_ancestor: str) -> bool:
+    """
+    Check whether MAYBE_ANCESTOR is reachable from COMMIT.
+    Commits with a generation no higher than MAYBE_ANCESTOR's cannot reach
+    it, so the walk stops there.
+    """
+    if not data.object_exists(maybe_ancestor):
+        return False
+
+    cutoff = get_commit_node(maybe_ancestor).generation
+    stack = [commit]
+    visited: set[str] = set()
+    while stack:
+        oid = stack.pop()
+        if oid == maybe_ancestor:
+            return True
+        if oid in visited:
+            continue
+        visited.add(oid)
+        node = get_commit_node(oid)
+        if node.generation > cutoff:
+            stack.extend(node.parents)
+    return False
+
+
+def get_commit_node(oid: str) -> graph.Node:
+    """
+    Return the commit graph node (tree, parents, generation) for a commit.
+    Commits missing from the commit-graph file are parsed, along with any of
+    their ancestors that are missing too.
+
+    Args: Commit OID (str)
+    Returns: graph.Node
+    """
+    stack = [oid]
+    while True:
+        top = stack[-1]
+        node = _known_node(top)
+        if node is not None:
+            _ = stack.pop()
+            if not stack:
+                return node
+            continue
+
+        commit = get_commit(top)
+        parents = [_known_node(parent) for parent in commit.parents]
+        missing = [p for p, node in zip(commit.parents, parents) if node is None]
+        if missing:
+            stack.extend(missing)
+            continue
+
+        generation = 1 + max((node.generation for node in parents), default=0)
+        node = graph.Node(
+            tree=commit.tree, parents=commit.parents, generation=generation
+        )
+        _node_cache.put(top, node)
+
+
+def _known_node(oid: str) -> graph.Node | None:
+    """
+    Graph node for OID from the commit-graph file or the cache, without
+    parsing anything
+    """
+    commit_graph = data.get_commit_graph()
+    node = commit_graph.get(oid) if commit_graph is not None else None
+    return node if node is not None else _node_cache.get(oid)
 
 
-def is_ancestor_of(commit, maybe_ancestor):
-    return maybe_ancestor in iter_commits_and_parents({commit})
+def update_commit_graph(oids) -> int:
+    """
+    Add OIDS and their ancestors to the commit graph.
+    Only commits missing from the graph are parsed, and they are written as
+    a new layer instead of rewriting the whole graph.
+
+    Args: Commit OIDs
+    Returns: Number of commits added (int)
+    """
+    commit_graph = data.get_commit_graph()
+    new: dict[str, graph.Node] = {}
+    stack = [oid for oid in oids if oid]
+    while stack:
+        oid = stack.pop()
+        if oid in new or (commit_graph is not None and oid in commit_graph):
+            continue
+        new[oid] = get_commit_node(oid)
+        stack.extend(new[oid].parents)
+
+    if not new:
+        return 0
+
+    # The new commits go into a layer of their own on top of the existing
+    # ones. Layers no more than twice its size are folded into it, which
+    # keeps layer sizes growing geometrically: a commit is only rewritten
+    # O(log n) times, never on every update
+    nodes = dict(new)
+    blooms: dict[str, bytes] = {}
+    base_layer = commit_graph
+    while base_layer is not None and base_layer.count <= 2 * len(nodes):
+        for oid in base_layer.iter_layer():
+            nodes[oid] = base_layer.get(oid)
+            filter_ = base_layer.get_bloom(oid)
+            if filter_ is not None:
+                blooms[oid] = filter_
+        base_layer = base_layer.base
+
+    # Filters are missing for new commits and for graphs written before
+    # there were any
+    for oid, node in nodes.items():
+        if oid not in blooms:
+            parent = node.parents[0] if node.parents else None
+            parent_tree = get_commit_node(parent).tree if parent else None
+            changes = iter_tree_changes(parent_tree, node.tree)
+            blooms[oid] = bloom.build(path for path, *_ in changes)
+    data.write_commit_graph(nodes, blooms, base_layer)
+    return len(new)
+
+
+def commit_changes_paths(oid: str, paths: list[str]) -> bool:
+    """
+    Whether commit OID changed any of PATHS (files or directories) compared
+    to its first parent. The commit's changed-path Bloom filter rules most
+    commits out without reading a tree, the trees are only diffed to
+    confirm a possible match.
+
+    Args: Commit OID (str), paths relative to the repository root
+    Returns: bool
+    """
+    paths = [os.path.normpath(path).replace(os.sep, "/") for path in paths]
+    if "." in paths:
+        return True
+
+    commit_graph = data.get_commit_graph()
+    filter_ = commit_graph.get_bloom(oid) if commit_graph is not None else None
+    if filter_ is not None and not any(
+        bloom.may_contain(filter_, path) for path in paths
+    ):
+        return False
+
+    node = get_commit_node(oid)
+    parent_tree = get_commit_node(node.parents[0]).tree if node.parents else None
+    return any(
+        changed == path or changed.startswith(f"{path}/")
+        for changed, *_ in iter_tree_changes(parent_tree, node.tree)
+        for path in paths
+    )
+
+
+class AddResult(NamedTuple):
+    """
+    Summary of an add: how many files were hashed and how many were skipped
+    because their stat data matched the index.
+    """
+
+    hashed: int
+    skipped: int
 
 
-def add(filenames):
-    def add_file(filename):
-        filename = os.path.relpath(filename)
-        with open(filename, "rb") as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
+def add(filenames, progress=None) -> AddResult:
+    """
+    Stage files and directories.
+    Files whose stat data matches their index entry are skipped. Small files
+    are hashed in batches on a process pool when there are many of them,
+    large files are streamed on a thread pool.
 
-    def add_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                path = os.path.relpath(os.path.join(root, filename))
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(path)
+    Args: filenames (list[str]), progress (callable(done, total)) <Optional>
+    Returns: AddResult
+    """
+    candidates: list[tuple[str, os.stat_result]] = []
+    for name in filenames:
+        if os.path.isfile(name):
+            candidates.append((os.path.relpath(name), os.stat(name)))
+        elif os.path.isdir(name):
+            candidates.extend(_iter_working_files(name))
 
     with data.get_index() as index:
-        for name in filenames:
-            if os.path.isfile(name):
-                add_file(name)
-            elif os.path.isdir(name):
-                add_directory(name)
+        to_hash = [
+            (path, st)
+            for path, st in candidates
+            if not data.stat_matches(index, path, st)
+        ]
+        small = [path for path, st in to_hash if st.st_size < ADD_LARGE_FILE]
+        large = [path for path, st in to_hash if st.st_size >= ADD_LARGE_FILE]
+        stats = dict(to_hash)
+
+        done = 0
+        for paths, oids in _hash_files(small, large):
+            for path, oid in zip(paths, oids):
+                index[path] = data.index_entry(path, oid, stats[path])
+            done += len(paths)
+            if progress is not None:
+                progress(done, len(to_hash))
+
+    return AddResult(hashed=len(to_hash), skipped=len(candidates) - len(to_hash))
+
+
+def _hash_files(small: list[str], large: list[str]):
+    """
+    Store the given files as blobs, yielding (paths, oids) as batches finish
+    """
+    batches = [
+        small[i : i + ADD_BATCH_SIZE] for i in range(0, len(small), ADD_BATCH_SIZE)
+    ]
+    if len(small) >= ADD_PROCESS_MIN_FILES:
+        # Many small files are dominated by per-file Python overhead, which
+        # only separate processes can run in parallel
+        executor = ProcessPoolExecutor(
+            ADD_WORKERS, initializer=data.set_git_dir, initargs=(data.git_dir,)
+        )
+    else:
+        executor = ThreadPoolExecutor(ADD_WORKERS)
+
+    with executor, ThreadPoolExecutor(ADD_WORKERS) as large_executor:
+        futures = {executor.submit(_hash_batch, batch): batch for batch in batches}
+        # Hashing and compressing large buffers releases the GIL
+        futures.update(
+            (large_executor.submit(_hash_batch, [path]), [path]) for path in large
+        )
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def _hash_batch(paths: list[str]) -> list[str]:
+    """
+    Store a batch of files as blobs
+    """
+    oids = []
+    for path in paths:
+        with open(path, "rb") as f:
+            oids.append(data.hash_object_stream(f))
+    return oids
 
 
 def get_index_tree():
     with data.get_index() as index:
-        return index
+        return {path: entry.oid for path, entry in index.items()}
@@ -0,0 +1,57 @@
+import zlib
+from collections.abc import Iterable
+
+# Filter size and probes, giving about 1% false positives
+BITS_PER_PATH = 10
+HASHES = 7
+
+# Commits changing more paths get a filter that matches everything
+MAX_PATHS = 512
+MATCH_ALL = b"\xff"
+
+_SEED = 0x5BD1E995
+
+
+def path_keys(path: str) -> list[str]:
+    """
+    PATH and every directory leading to it, so a filter also answers for
+    the directories a changed file is in
+    """
+    parts = path.split("/")
+    return ["/".join(parts[: i + 1]) for i in range(len(parts))]
+
+
+def build(paths: Iterable[str]) -> bytes:
+    """
+    Bloom filter holding PATHS and their leading directories
+
+    Args: changed paths
+    Returns: filter (bytes)
+    """
+    keys = {key for path in paths for key in path_keys(path)}
+    if len(keys) > MAX_PATHS:
+        return MATCH_ALL
+
+    size = max(8, (len(keys) * BITS_PER_PATH + 7) // 8)
+    bits = bytearray(size)
+    for key in keys:
+        for bit in _probes(key, 8 * size):
+            bits[bit // 8] |= 1 << bit % 8
+    return bytes(bits)
+
+
+def may_contain(bloom: bytes, path: str) -> bool:
+    """
+    False if PATH (a file or directory) is certainly not in BLOOM
+    """
+    return all(bloom[bit // 8] >> bit % 8 & 1 for bit in _probes(path, 8 * len(bloom)))
+
+
+def _probes(key: str, nbits: int) -> list[int]:
+    """
+    Bit positions of KEY, by double hashing
+    """
+    encoded = key.encode()
+    h1 = zlib.crc32(encoded)
+    h2 = zlib.crc32(encoded, _SEED) | 1
+    return [(h1 + i * h2) % nbits for i in range(HASHES)]
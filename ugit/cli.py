@@ -1,4 +1,7 @@
 import argparse
+from datetime import datetime, timedelta, timezone
+import itertools
+import re
 import subprocess
 import os
 import sys
@@ -10,7 +13,9 @@ from collections import defaultdict
 from . import data
 from . import base
 from . import diff
+from . import diffalgo
 from . import remote
+from . import server
 
 
 def main() -> None:
@@ -19,7 +24,14 @@ def main() -> None:
     """
     with data.change_git_dir("."):
         args = parse_args()
+        if args.cache_size is not None:
+            data.object_cache.resize(args.cache_size)
+        diffalgo.default = args.diff_algorithm
         args.func(args)
+        if args.cache_stats:
+            for name, stats in data.cache_stats().items():
+                counters = " ".join(f"{key}={value}" for key, value in stats.items())
+                print(f"cache {name}: {counters}", file=sys.stderr)
 
 
 def parse_args():
@@ -27,8 +39,20 @@ def parse_args():
     Helper function to parse argument
     """
     parser = argparse.ArgumentParser()
+    _ = parser.add_argument(
+        "--cache-size", type=int, help="byte budget of the object cache"
+    )
+    _ = parser.add_argument(
+        "--cache-stats", action="store_true", help="print cache counters on exit"
+    )
+    _ = parser.add_argument(
+        "--diff-algorithm",
+        choices=diffalgo.ALGORITHMS,
+        default=diffalgo.default,
+        help="algorithm used by diff, show and merge",
+    )
 
-    oid = base.get_oid
+    oid = _parse_oid
 
     commands = parser.add_subparsers(dest="command")
     commands.required = True
@@ -58,6 +82,15 @@ def parse_args():
     log_parser = commands.add_parser("log")
     log_parser.set_defaults(func=log)
     _ = log_parser.add_argument("oid", default="@", type=oid, nargs="?")
+    _ = log_parser.add_argument("--abbrev-commit", action="store_true")
+    _ = log_parser.add_argument("-n", "--max-count", type=int)
+    _ = log_parser.add_argument(
+        "--since", type=parse_date, help="epoch seconds, ISO date or 'N days ago'"
+    )
+    _ = log_parser.add_argument("--until", type=parse_date)
+    _ = log_parser.add_argument(
+        "--topo-order", action="store_true", help="never show parents before children"
+    )
 
     show_parser = commands.add_parser("show")
     show_parser.set_defaults(func=show)
@@ -79,11 +112,13 @@ def parse_args():
 
     k_parser = commands.add_parser("k")
     k_parser.set_defaults(func=k)
+    _ = k_parser.add_argument("-n", "--max-count", type=int)
 
     branch_parser = commands.add_parser("branch")
     branch_parser.set_defaults(func=branch)
     _ = branch_parser.add_argument("name", nargs="?")
-    _ = branch_parser.add_argument("starting_point", default="@", type=oid, nargs="?")
+    _ = branch_parser.add_argument("-v", "--verbose", action="store_true")
+    _ = branch_parser.add_argument("starting_point", type=oid, nargs="?")
 
     status_parser = commands.add_parser("status")
     status_parser.set_defaults(func=status)
@@ -104,17 +139,68 @@ def parse_args():
     fetch_parser = commands.add_parser("fetch")
     fetch_parser.set_defaults(func=fetch)
     _ = fetch_parser.add_argument("remote")
+    _ = fetch_parser.add_argument(
+        "--filter",
+        choices=["blob:none"],
+        help="Leave blobs on the remote and fetch them when they are first read",
+    )
+
+    clone_parser = commands.add_parser("clone")
+    clone_parser.set_defaults(func=clone)
+    _ = clone_parser.add_argument("source")
+    _ = clone_parser.add_argument("directory")
+    _ = clone_parser.add_argument(
+        "--shared",
+        action="store_true",
+        help="Read objects from the source through alternates instead of linking them",
+    )
 
     push_parser = commands.add_parser("push")
     push_parser.set_defaults(func=push)
     _ = push_parser.add_argument("remote")
     _ = push_parser.add_argument("branch")
 
+    serve_parser = commands.add_parser("serve")
+    serve_parser.set_defaults(func=serve)
+    _ = serve_parser.add_argument("url")
+
     add_parser = commands.add_parser("add")
     add_parser.set_defaults(func=add)
     _ = add_parser.add_argument("files", nargs="+")
 
-    return parser.parse_args()
+    migrate_objects_parser = commands.add_parser("migrate-objects")
+    migrate_objects_parser.set_defaults(func=migrate_objects)
+
+    repack_parser = commands.add_parser("repack")
+    repack_parser.set_defaults(func=repack)
+
+    pack_refs_parser = commands.add_parser("pack-refs")
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    gc_parser = commands.add_parser("gc")
+    gc_parser.set_defaults(func=gc)
+    _ = gc_parser.add_argument(
+        "--prune-after",
+        type=float,
+        default=base.GC_GRACE_SECONDS,
+        metavar="SECONDS",
+        help="Only prune unreachable objects older than this",
+    )
+    _ = gc_parser.add_argument(
+        "--repack", action="store_true", help="Pack the surviving objects"
+    )
+
+    # For log, everything after "--" is a path, never a revision. Other
+    # commands leave "--" to argparse, so their arguments may start with "-"
+    argv = sys.argv[1:]
+    paths: list[str] = []
+    command = next((arg for arg in argv if arg in commands.choices), None)
+    if command == "log" and "--" in argv:
+        argv, paths = argv[: argv.index("--")], argv[argv.index("--") + 1 :]
+
+    args = parser.parse_args(argv)
+    args.paths = paths
+    return args
 
 
 def init(args: argparse.Namespace) -> None:
@@ -138,7 +224,7 @@ def hash_object(args: argparse.Namespace) -> None:
     """
     _ = args
     with open(args.file, "rb") as f:
-        print(data.hash_object(f.read()))
+        print(data.hash_object_stream(f))
 
 
 def cat_file(args: argparse.Namespace) -> None:
@@ -149,7 +235,7 @@ def cat_file(args: argparse.Namespace) -> None:
     Returns: None
     """
     _ = sys.stdout.flush()
-    _ = sys.stdout.buffer.write(data.get_object(args.object, expected=None))
+    data.stream_object(args.object, sys.stdout.buffer, expected=None)
 
 
 def write_tree(args: argparse.Namespace) -> None:
@@ -192,10 +278,7 @@ def show(args: argparse.Namespace) -> None:
     if not args.oid:
         return
 
-    oid_ref = data.get_ref(args.oid)
-    oid = oid_ref.value
-    assert oid is not None
-
+    oid = args.oid
     commit = base.get_commit(oid)
     parent_tree = None
     if commit.parents:
@@ -204,17 +287,17 @@ def show(args: argparse.Namespace) -> None:
     _print_commit(oid, commit)
 
     if parent_tree is not None:
-        results = diff.diff_trees(
-            base.get_tree(parent_tree), base.get_tree(commit.tree)
+        _write_diff(
+            diff.iter_diff_changes(base.iter_tree_changes(parent_tree, commit.tree))
         )
-        print(results)
 
 
 def log(args: argparse.Namespace) -> None:
     """
-    Pass in Object ID and get commit history
+    Pass in Object ID and get commit history, limited to the commits that
+    changed the paths given after "--"
 
-    Args: Object ID
+    Args: Object ID, paths
     Returns: None
     """
     refs: defaultdict[str, list[str]] = defaultdict(list)
@@ -223,25 +306,78 @@ def log(args: argparse.Namespace) -> None:
         assert ref_value.value is not None
         refs[ref_value.value].append(ref_name)
 
-    oids = args.oid
-    oids = data.get_ref(oids)
-    assert oids.value is not None
+    oids = base.iter_commits(
+        {args.oid},
+        order="topo" if args.topo_order else "date",
+        since=args.since,
+        until=args.until,
+    )
+    if args.paths:
+        oids = (oid for oid in oids if base.commit_changes_paths(oid, args.paths))
 
-    for oid in base.iter_commits_and_parents({oids.value}):
+    for oid in itertools.islice(oids, args.max_count):
         commit = base.get_commit(oid)
-        _print_commit(oid, commit, refs.get(oid))
+        _print_commit(oid, commit, refs.get(oid), args.abbrev_commit)
+
+
+def parse_date(value: str) -> int:
+    """
+    Parse epoch seconds, an ISO 8601 date (local time unless it has an
+    offset) or "N <unit>s ago" into epoch seconds
+    """
+    if value.isdigit():
+        return int(value)
+
+    relative = re.fullmatch(r"(\d+)\s*(second|minute|hour|day|week)s?\s+ago", value)
+    if relative:
+        amount, unit = relative.groups()
+        delta = timedelta(**{f"{unit}s": int(amount)})
+        return int((datetime.now() - delta).timestamp())
+
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Unknown date {value}")
+
+
+def _parse_oid(name: str) -> str:
+    """
+    argparse type resolving NAME to an OID, reporting a ref without a
+    commit as a usage error
+    """
+    try:
+        return base.get_oid(name)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 
-def _print_commit(oid: str, commit: base.Commit, refs: list[str] | None = None):
+def _print_commit(
+    oid: str, commit: base.Commit, refs: list[str] | None = None, abbrev=False
+):
     """
     Pretty-print a commit hash, associated refs and the commit message body.
     """
     refs_str = f" ({', '.join(refs)})" if refs else ""
-    print(f"commit {oid} {refs_str}\n")
+    print(f"commit {base.abbreviate(oid) if abbrev else oid} {refs_str}")
+    if commit.author:
+        print(f"Author: {commit.author.identity}")
+        print(f"Date:   {_format_date(commit.author)}")
+    print("")
     print(textwrap.indent(commit.message, "     "))
     print("")
 
 
+def _format_date(signature: base.Signature) -> str:
+    """
+    A signature's time in its own UTC offset, as git log shows it
+    """
+    sign = -1 if signature.offset.startswith("-") else 1
+    hours, minutes = int(signature.offset[1:3]), int(signature.offset[3:5])
+    tz = timezone(sign * timedelta(hours=hours, minutes=minutes))
+    when = datetime.fromtimestamp(signature.timestamp, tz)
+    return f"{when:%a %b %d %H:%M:%S %Y} {signature.offset}"
+
+
 def checkout(args: argparse.Namespace) -> None:
     """
     Takes in a COMMIT OID and returns the state to said Commit
@@ -250,7 +386,8 @@ def checkout(args: argparse.Namespace) -> None:
     Returns: None
     """
 
-    base.checkout(args.commit)
+    touched = base.checkout(args.commit)
+    print(f"Updated {touched} files")
 
 
 def tag(args: argparse.Namespace) -> None:
@@ -272,11 +409,21 @@ def branch(args: argparse.Namespace) -> None:
         current = base.get_branch_name()
         for branch in base.iter_branch_names():
             prefix = "*" if branch == current else " "
-            print(f"{prefix} {branch}")
+            if args.verbose:
+                oid = base.get_oid(os.path.join("refs", "heads", branch))
+                print(f"{prefix} {branch} {base.abbreviate(oid)}")
+            else:
+                print(f"{prefix} {branch}")
 
     else:
-        base.create_branch(args.name, args.starting_point)
-        print(f"Branch {args.name} created at {args.starting_point[:10]}...")
+        starting_point = args.starting_point
+        if starting_point is None:
+            try:
+                starting_point = base.get_oid("@")
+            except ValueError as e:
+                sys.exit(f"Cannot create branch {args.name}: {e}")
+        base.create_branch(args.name, starting_point)
+        print(f"Branch {args.name} created at {base.abbreviate(starting_point)}")
 
 
 def k(args: argparse.Namespace) -> None:
@@ -292,10 +439,10 @@ def k(args: argparse.Namespace) -> None:
         if not ref_oid.symbolic and ref_oid.value is not None:
             oids.add(ref_oid.value)
 
-    for oid in base.iter_commits_and_parents(oids):
+    for oid in itertools.islice(base.iter_commits(oids), args.max_count):
         commit = base.get_commit(oid)
         # print(oid)
-        dot += f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
+        dot += f'"{oid}" [shape=box style=filled label="{base.abbreviate(oid)}"]\n'
         for parent in commit.parents:
             dot += f'"{oid}" -> "{parent}"\n'
 
@@ -323,31 +470,27 @@ def status(args: argparse.Namespace) -> None:
     Show branch/merge status and list the files staged for commit.
     """
     _ = args
-    head = base.get_oid("@")
+    head = data.get_ref("HEAD").value
     branch = base.get_branch_name()
 
     if branch:
         print(f"On branch {branch}")
     else:
-        print(f"HEAD Detached at {head[10:]}")
+        assert head is not None
+        print(f"HEAD Detached at {head[:10]}")
 
     MERGE_HEAD = data.get_ref("MERGE_HEAD").value
     if MERGE_HEAD:
         print(f"merging with {MERGE_HEAD[:10]}")
 
     print("\nChanges to be commited: \n")
-    head = data.get_ref(head).value
-    HEAD_tree = head and base.get_commit(head).tree
-    assert HEAD_tree is not None
-
-    for path, action in diff.iter_changed_files(
-        base.get_tree(HEAD_tree), base.get_index_tree()
-    ):
+    for path, action in diff.iter_changed_actions(base.iter_staged_changes()):
         print(f"{action:>12}: {path}")
 
     print("\nChanges not staged for commit: \n")
-    for path, action in diff.iter_changed_files(
-        base.get_index_tree(), base.get_working_tree()
+    index_tree = base.get_index_tree()
+    for path, action in diff.iter_changed_actions(
+        base.iter_tree_changes(index_tree, base.get_working_tree())
     ):
         print(f"{action:>12}: {path}")
 
@@ -363,28 +506,28 @@ def _diff(args: argparse.Namespace) -> None:
     """
     Compare the working tree to the specified commit (HEAD by default).
     """
-
-    commit_oid = data.get_ref(args.commit).value
-    assert commit_oid is not None
-
+    tree_from = None
     if args.commit:
-        tree = args.commit and base.get_commit(commit_oid).tree
-        tree_from = base.get_tree(tree)
+        tree_from = base.get_commit(base.get_oid(args.commit)).tree
 
     if args.cached:
-        tree_to = base.get_index_tree()
-        if not args.commit:
-            oid = base.get_oid("@")
-            tree = oid and base.get_commit(oid).tree
-            tree_from = base.get_tree(tree)
+        changes = base.iter_staged_changes(tree_from)
     else:
-        tree_to = base.get_working_tree()
         if not args.commit:
             tree_from = base.get_index_tree()
+        changes = base.iter_tree_changes(tree_from, base.get_working_tree())
+
+    _write_diff(diff.iter_diff_changes(changes))
+
 
-    result = diff.diff_trees(tree_from, tree_to)
+def _write_diff(hunks) -> None:
+    """
+    Write per-file diff hunks to stdout as they are produced.
+    """
     _ = sys.stdout.flush()
-    _ = sys.stdout.buffer.write(result.encode())
+    for hunk in hunks:
+        _ = sys.stdout.buffer.write(hunk.encode())
+        _ = sys.stdout.flush()
 
 
 def merge(args: argparse.Namespace) -> None:
@@ -402,13 +545,106 @@ def merge_base(args: argparse.Namespace) -> None:
 
 
 def fetch(args: argparse.Namespace) -> None:
-    remote.fetch(args.remote)
+    stats = remote.fetch(args.remote, _transfer_progress, blobs=args.filter is None)
+    _print_transfer("Fetched", stats)
+
+
+def clone(args: argparse.Namespace) -> None:
+    """
+    Clone a local repository, sharing its objects instead of copying them.
+    """
+    linked = remote.clone(args.source, args.directory, args.shared)
+    if args.shared:
+        print(f"Cloned into {args.directory}, sharing objects with {args.source}")
+    else:
+        print(f"Cloned into {args.directory}, {linked} object files hardlinked")
 
 
 def push(args: argparse.Namespace) -> None:
     branch_path = os.path.join("refs", "heads", args.branch)
-    remote.push(args.remote, branch_path)
+    stats = remote.push(args.remote, branch_path, _transfer_progress)
+    _print_transfer("Pushed", stats)
+
+
+def serve(args: argparse.Namespace) -> None:
+    """
+    Serve this repository to fetch and push clients on a Unix or TCP socket.
+    """
+    print(f"Serving on {args.url}", file=sys.stderr)
+    try:
+        server.serve(args.url)
+    except KeyboardInterrupt:
+        pass
+
+
+def _transfer_progress(phase: str, done: int, total: int) -> None:
+    if sys.stderr.isatty():
+        end = "\n" if done == total else ""
+        print(f"\r{phase}: {done}/{total}", end=end, file=sys.stderr)
+
+
+def _print_transfer(action: str, stats: remote.TransferStats) -> None:
+    kib = stats.bytes / 1024
+    rate = kib / stats.seconds if stats.seconds else 0.0
+    print(
+        f"{action} {stats.objects} objects, {kib:.1f} KiB "
+        f"in {stats.seconds:.2f}s ({rate:.1f} KiB/s)"
+    )
 
 
 def add(args: argparse.Namespace) -> None:
-    base.add(args.files)
+    def progress(done: int, total: int) -> None:
+        if sys.stderr.isatty():
+            print(f"\rHashing files: {done}/{total}", end="", file=sys.stderr)
+
+    result = base.add(args.files, progress)
+    if result.hashed and sys.stderr.isatty():
+        print(file=sys.stderr)
+    print(f"{result.hashed} files hashed, {result.skipped} unchanged files skipped")
+
+
+def migrate_objects(args: argparse.Namespace) -> None:
+    """
+    Move objects from the old flat layout into the compressed fan-out layout.
+    """
+    _ = args
+    print(f"Migrated {data.migrate_objects()} objects")
+
+
+def repack(args: argparse.Namespace) -> None:
+    """
+    Pack all loose and packed objects into a single delta-compressed pack
+    and write reachability bitmaps for it.
+    """
+    _ = args
+    print(f"Packed {data.repack()} objects")
+    print(f"Wrote {base.write_bitmaps()} bitmaps")
+
+
+def pack_refs(args: argparse.Namespace) -> None:
+    """
+    Consolidate loose refs into the packed-refs file.
+    """
+    _ = args
+    print(f"Packed {data.pack_refs()} refs")
+
+
+def gc(args: argparse.Namespace) -> None:
+    """
+    Prune unreachable objects and optionally repack, reporting the object
+    store before and after.
+    """
+    before = data.count_objects()
+    pruned = base.gc(args.prune_after, args.repack)
+    after = data.count_objects()
+    print(f"Pruned {pruned} unreachable objects")
+    _print_object_stats("Before", before)
+    _print_object_stats("After", after)
+
+
+def _print_object_stats(label: str, stats: data.ObjectStats) -> None:
+    print(
+        f"{label}: {stats.loose} loose objects ({stats.loose_bytes / 1024:.1f} KiB), "
+        f"{stats.packed} packed objects in {stats.packs} packs "
+        f"({stats.pack_bytes / 1024:.1f} KiB)"
+    )
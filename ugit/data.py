@@ -1,14 +1,56 @@
+import bisect
 from codecs import getreader
+from collections import OrderedDict
+from collections.abc import Callable
 from contextlib import contextmanager
 import os
 import hashlib
-from typing import NamedTuple
+import mmap
+import struct
+import tempfile
+import threading
+from typing import IO, Any, NamedTuple
 import shutil
 import json
+import zlib
 
+from . import graph
+from . import pack
 
 git_dir = ".ugit"
 
+# Open packs per pack directory, refreshed when the directory changes
+_packs: dict[str, tuple[int, dict[str, pack.Pack]]] = {}
+_packs_lock = threading.Lock()
+
+# Open commit graph per repository, refreshed when the file changes
+_commit_graphs: dict[str, tuple[tuple[int, int], graph.CommitGraph]] = {}
+
+# alternates file path -> (mtime, object directories listed in it)
+_alternates: dict[str, tuple[int, list[str]]] = {}
+
+PACKED_REFS_HEADER = "# pack-refs with: peeled sorted"
+
+# Loose object directory -> (mtime, sorted OIDs stored in it)
+_loose_oids: dict[str, tuple[int, list[str]]] = {}
+
+# packed-refs path -> (stat key, sorted ref names, matching (OID, peeled OID))
+_packed_refs: dict[
+    str, tuple[tuple[int, int, int], list[str], list[tuple[str, str | None]]]
+] = {}
+
+# Objects the promisor remote was asked for but did not have
+_promisor_missing: set[str] = set()
+_promisor_lock = threading.Lock()
+
+# Every LRUCache registers itself here so cache_stats can report on all of them
+_caches: dict[str, "LRUCache"] = {}
+
+OBJECT_CACHE_BYTES = 32 * 1024 * 1024
+
+# Read / write size used when streaming objects
+CHUNK_SIZE = 64 * 1024
+
 
 class RefValue(NamedTuple):
     """
@@ -20,6 +62,87 @@ class RefValue(NamedTuple):
     value: str | None
 
 
+class LRUCache:
+    """
+    Least recently used cache bounded by the total size of its values.
+    SIZEOF measures one value, by default its length.
+    Keeps hit and miss counters to help tune the budget.
+    Safe to share between threads.
+    """
+
+    def __init__(
+        self, name: str, budget: int, sizeof: Callable[[Any], int] = len
+    ) -> None:
+        self.name = name
+        self.budget = budget
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value: Any) -> None:
+        size = self.sizeof(value)
+        if size > self.budget:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            self._evict()
+
+    def resize(self, budget: int) -> None:
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "size": self.size,
+            "budget": self.budget,
+        }
+
+    def _evict(self) -> None:
+        while self.size > self.budget:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size -= size
+
+
+# Decoded objects as (type, content), content addressed so safe across repositories
+object_cache = LRUCache(
+    "objects", OBJECT_CACHE_BYTES, sizeof=lambda value: len(value[1])
+)
+
+
+def cache_stats() -> dict[str, dict[str, int]]:
+    """
+    Counters of every registered cache, keyed by cache name
+    """
+    return {name: cache.stats() for name, cache in _caches.items()}
+
+
 @contextmanager
 def change_git_dir(new_dir: str):
     """
@@ -28,8 +151,19 @@ def change_git_dir(new_dir: str):
     global git_dir
     old_dir = git_dir
     git_dir = os.path.join(new_dir, ".ugit")
-    yield
-    git_dir = old_dir
+    try:
+        yield
+    finally:
+        git_dir = old_dir
+
+
+def set_git_dir(path: str) -> None:
+    """
+    Point GIT_DIR at PATH for good. Used as the initializer of worker
+    processes, which need to be told where the repository is.
+    """
+    global git_dir
+    git_dir = path
 
 
 def init() -> None:
@@ -43,7 +177,7 @@ def init() -> None:
 def hash_object(data: bytes, type_: str = "blob") -> str:
     """
     create Object ID (Hash) for object using type, null, and data
-    Stores the result in the objects/ directory in .ugit
+    Stores the zlib compressed result under objects/<oid[:2]>/<oid[2:]> in .ugit
 
     Args: Data (bytes), type_ (str)
     Returns: OID (str)
@@ -51,13 +185,8 @@ def hash_object(data: bytes, type_: str = "blob") -> str:
     obj = type_.encode() + b"\x00" + data
     oid = hashlib.sha1(obj).hexdigest()
 
-    # handle using correct slashes in all os
-    out_file_location: str = os.path.join(git_dir, "objects", oid)
-
-    # Create a objects folder if it doesn't exist
-    os.makedirs(os.path.dirname(out_file_location), exist_ok=True)
-    with open(out_file_location, "wb") as out:
-        _ = out.write(obj)
+    if not _freshen_object(oid) and not object_exists(oid):
+        _write_object(oid, obj)
     return oid
 
 
@@ -69,19 +198,690 @@ def get_object(object: str, expected: str | None = "blob") -> bytes:
     Args: OID (str), expected (str)
     Returns: Data (Bytes)
     """
-    object_location: str = os.path.join(git_dir, "objects", object)
-
-    with open(object_location, "rb") as f:
-        obj = f.read()
-
-    type_, _, content = obj.partition(b"\x00")
-    type_ = type_.decode()
+    cached = object_cache.get(object)
+    if cached is None:
+        type_, _, content = _read_object(object).partition(b"\x00")
+        type_ = type_.decode()
+        object_cache.put(object, (type_, content))
+    else:
+        type_, content = cached
 
     if expected is not None:
         assert type_ == expected, f"Expected {expected}, got {type_}"
     return content
 
 
+def hash_object_stream(f: IO[bytes], type_: str = "blob") -> str:
+    """
+    Same as hash_object, but reads the content from a file object in chunks
+    so memory use does not depend on the size of the object.
+    The object is compressed into a temporary file and renamed into place.
+
+    Args: file object opened in binary mode, type_ (str)
+    Returns: OID (str)
+    """
+    header = type_.encode() + b"\x00"
+    hasher = hashlib.sha1(header)
+    compressor = zlib.compressobj()
+
+    objects_dir = os.path.join(git_dir, "objects")
+    with tempfile.NamedTemporaryFile(dir=objects_dir, delete=False) as tmp:
+        try:
+            _ = tmp.write(compressor.compress(header))
+            while chunk := f.read(CHUNK_SIZE):
+                hasher.update(chunk)
+                _ = tmp.write(compressor.compress(chunk))
+            _ = tmp.write(compressor.flush())
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+
+    oid = hasher.hexdigest()
+    if _freshen_object(oid) or object_exists(oid):
+        os.remove(tmp.name)
+    else:
+        os.makedirs(os.path.dirname(_object_path(oid)), exist_ok=True)
+        os.replace(tmp.name, _object_path(oid))
+    return oid
+
+
+def hash_file(path: str, type_: str = "blob") -> str:
+    """
+    Compute the OID a file would get as an object without storing it
+
+    Args: Path (str), type_ (str)
+    Returns: OID (str)
+    """
+    hasher = hashlib.sha1(type_.encode() + b"\x00")
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def stream_object(oid: str, out: IO[bytes], expected: str | None = "blob") -> None:
+    """
+    Write the content of OID to a file object in chunks, without holding
+    the whole object in memory when it is stored as a loose object
+
+    Args: OID (str), file object opened in binary mode, expected (str)
+    Returns: None
+    """
+    cached = object_cache.get(oid)
+    if cached is not None:
+        type_, content = cached
+        if expected is not None:
+            assert type_ == expected, f"Expected {expected}, got {type_}"
+        _ = out.write(content)
+        return
+
+    chunks = _iter_loose_object_chunks(oid)
+    if chunks is None:
+        _ = out.write(get_object(oid, expected))
+        return
+
+    header: bytes | None = b""
+    for chunk in chunks:
+        if header is not None:
+            header += chunk
+            if b"\x00" not in header:
+                continue
+            type_, _, chunk = header.partition(b"\x00")
+            if expected is not None:
+                assert type_.decode() == expected, f"Expected {expected}, got {type_}"
+            header = None
+        _ = out.write(chunk)
+
+
+def _iter_loose_object_chunks(oid: str):
+    """
+    Yield the raw object (header + content) of a loose object in chunks,
+    or return None if OID is not a loose object
+    """
+    try:
+        f = open(_object_path(oid), "rb")
+        decompressor = zlib.decompressobj()
+    except FileNotFoundError:
+        try:
+            f = open(_legacy_object_path(oid), "rb")
+            decompressor = None
+        except FileNotFoundError:
+            return None
+
+    def iter_chunks():
+        with f:
+            while chunk := f.read(CHUNK_SIZE):
+                if decompressor is None:
+                    yield chunk
+                    continue
+                # Bound the output so highly compressible objects stay small
+                yield decompressor.decompress(chunk, CHUNK_SIZE)
+                while decompressor.unconsumed_tail:
+                    tail = decompressor.unconsumed_tail
+                    yield decompressor.decompress(tail, CHUNK_SIZE)
+            if decompressor is not None:
+                yield decompressor.flush()
+
+    return iter_chunks()
+
+
+def _object_path(oid: str, objects_dir: str | None = None) -> str:
+    """
+    Location of a loose object in the fan-out layout (objects/ab/cdef...)
+    """
+    objects_dir = objects_dir or os.path.join(git_dir, "objects")
+    return os.path.join(objects_dir, oid[:2], oid[2:])
+
+
+def _legacy_object_path(oid: str, objects_dir: str | None = None) -> str:
+    """
+    Location of a loose object in the old flat, uncompressed layout
+    """
+    return os.path.join(objects_dir or os.path.join(git_dir, "objects"), oid)
+
+
+def _object_dirs() -> list[str]:
+    """
+    The repository's own object directory followed by its alternates
+    """
+    return [os.path.join(git_dir, "objects"), *get_alternates()]
+
+
+def get_alternates() -> list[str]:
+    """
+    Object directories listed in objects/info/alternates, one per line,
+    including the alternates of those directories in turn.
+    Relative entries are relative to the objects directory listing them.
+
+    Args: None
+    Returns: list[str]
+    """
+    found: list[str] = []
+    pending = [os.path.abspath(os.path.join(git_dir, "objects"))]
+    seen = set(pending)
+    while pending:
+        objects_dir = pending.pop(0)
+        for alternate in _read_alternates(objects_dir):
+            alternate = os.path.normpath(os.path.join(objects_dir, alternate))
+            if alternate not in seen:
+                seen.add(alternate)
+                found.append(alternate)
+                pending.append(alternate)
+    return found
+
+
+def _read_alternates(objects_dir: str) -> list[str]:
+    path = os.path.join(objects_dir, "info", "alternates")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    cached = _alternates.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            lines = [line.strip() for line in f]
+        cached = (mtime, [line for line in lines if line and not line.startswith("#")])
+        _alternates[path] = cached
+    return cached[1]
+
+
+def add_alternate(objects_dir: str) -> None:
+    """
+    Let this repository read objects from another object directory
+    """
+    info_dir = os.path.join(git_dir, "objects", "info")
+    os.makedirs(info_dir, exist_ok=True)
+    with open(os.path.join(info_dir, "alternates"), "a") as f:
+        _ = f.write(os.path.abspath(objects_dir) + "\n")
+
+
+def link_objects(source_objects_dir: str) -> int:
+    """
+    Hardlink every loose object, pack and commit graph of another object
+    directory into this repository, copying where links are not possible.
+    Objects are never modified in place, so sharing the files is safe.
+
+    Args: source object directory (str)
+    Returns: Number of files linked or copied (int)
+    """
+    objects_dir = os.path.join(git_dir, "objects")
+    linked = 0
+    for root, _, filenames in os.walk(source_objects_dir):
+        rel_root = os.path.relpath(root, source_objects_dir)
+        for filename in filenames:
+            rel_path = os.path.normpath(os.path.join(rel_root, filename))
+            if filename.startswith("tmp") or rel_path == os.path.join(
+                "info", "alternates"
+            ):
+                continue
+            target = os.path.join(objects_dir, rel_path)
+            if os.path.exists(target):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(os.path.join(root, filename), target)
+            except OSError:
+                _ = shutil.copy2(os.path.join(root, filename), target)
+            linked += 1
+
+    # Keep reading whatever the source borrowed from its own alternates
+    for alternate in _read_alternates(os.path.abspath(source_objects_dir)):
+        add_alternate(os.path.join(os.path.abspath(source_objects_dir), alternate))
+    return linked
+
+
+def _write_object(oid: str, obj: bytes) -> None:
+    """
+    Compress the raw object (header + content) and store it as a loose object
+    """
+    out_file_location = _object_path(oid)
+    os.makedirs(os.path.dirname(out_file_location), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(out_file_location), delete=False
+    ) as tmp:
+        _ = tmp.write(zlib.compress(obj))
+    os.replace(tmp.name, out_file_location)
+
+
+def _freshen_object(oid: str) -> bool:
+    """
+    Touch the file holding OID, so gc sees a loose object that is being
+    written again as new and doesn't prune it. Packed objects are left
+    alone: gc only repacks what is reachable, and touching the pack would
+    make every object in it young.
+
+    Returns: False if OID is not stored in this repository (bool)
+    """
+    for path in (_object_path(oid), _legacy_object_path(oid)):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            pass
+
+    return any(oid in pack_ for pack_ in _get_packs())
+
+
+def _read_object(oid: str) -> bytes:
+    """
+    Read the raw object (header + content) from either loose object layout
+    or from one of the packs, fetching it from the promisor remote of a
+    partial clone if it is missing
+    """
+    try:
+        return _read_local_object(oid)
+    except FileNotFoundError:
+        if get_promisor() is None:
+            raise
+
+    _ = prefetch_objects([oid])
+    return _read_local_object(oid)
+
+
+def _read_local_object(oid: str) -> bytes:
+    for objects_dir in _object_dirs():
+        try:
+            with open(_object_path(oid, objects_dir), "rb") as f:
+                return zlib.decompress(f.read())
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(_legacy_object_path(oid, objects_dir), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+        for pack_ in _get_packs(objects_dir):
+            obj = pack_.read(oid)
+            if obj is not None:
+                return obj
+
+    raise FileNotFoundError(f"Object {oid} not found")
+
+
+def get_promisor() -> str | None:
+    """
+    Return the remote a partial fetch left objects behind on, if any
+    """
+    try:
+        with open(os.path.join(git_dir, "promisor")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def set_promisor(remote_path: str) -> None:
+    """
+    Record REMOTE_PATH as the remote to fetch missing objects from
+    """
+    with open(os.path.join(git_dir, "promisor"), "w") as f:
+        _ = f.write(remote_path)
+
+
+def prefetch_objects(oids) -> int:
+    """
+    Fetch the OIDS missing from this repository from the promisor remote,
+    all in one request. Does nothing in a complete repository.
+
+    Args: OIDs
+    Returns: Number of objects requested (int)
+    """
+    remote_path = get_promisor()
+    if remote_path is None:
+        return 0
+
+    # remote builds on this module, so it can only be imported lazily
+    from . import remote
+
+    with _promisor_lock:
+        missing = sorted(
+            {
+                oid
+                for oid in oids
+                if oid and oid not in _promisor_missing and not object_exists(oid)
+            }
+        )
+        if missing:
+            _ = remote.fetch_objects(remote_path, missing)
+            _promisor_missing.update(oid for oid in missing if not object_exists(oid))
+    return len(missing)
+
+
+def _get_packs(objects_dir: str | None = None) -> list[pack.Pack]:
+    """
+    Return the open packs of the current repository (or of OBJECTS_DIR)
+    """
+    pack_dir = os.path.join(objects_dir or os.path.join(git_dir, "objects"), "pack")
+    try:
+        mtime = os.stat(pack_dir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    # Packs that went away are only dropped, not closed: another thread may
+    # still be reading them, and their maps are released once it is done
+    with _packs_lock:
+        cached = _packs.get(pack_dir)
+        if cached is not None and cached[0] == mtime:
+            return list(cached[1].values())
+
+        old = cached[1] if cached is not None else {}
+        opened: dict[str, pack.Pack] = {}
+        for path in pack.iter_pack_paths(pack_dir):
+            opened[path] = old.get(path) or pack.Pack(path)
+
+        _packs[pack_dir] = (mtime, opened)
+        return list(opened.values())
+
+
+def _commit_graph_path() -> str:
+    return os.path.join(git_dir, "objects", "info", "commit-graph")
+
+
+def _commit_graph_layers_dir() -> str:
+    return os.path.join(git_dir, "objects", "info", "commit-graphs")
+
+
+def get_commit_graph() -> graph.CommitGraph | None:
+    """
+    Return the commit graph of the current repository or None if there is none.
+    It is the commit-graph file plus the layers listed, oldest first, in
+    commit-graphs/commit-graph-chain.
+    """
+    path = _commit_graph_path()
+    chain_path = os.path.join(_commit_graph_layers_dir(), "commit-graph-chain")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    try:
+        chain_st = os.stat(chain_path)
+        chain_key = (chain_st.st_mtime_ns, chain_st.st_size, chain_st.st_ino)
+    except FileNotFoundError:
+        chain_key = None
+
+    key = (st.st_mtime_ns, st.st_size, chain_key)
+    with _packs_lock:
+        cached = _commit_graphs.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        # The superseded graph is left open for threads still reading it
+        opened = graph.CommitGraph(path)
+        for name in _read_graph_chain():
+            layer_path = os.path.join(_commit_graph_layers_dir(), name)
+            opened = graph.CommitGraph(layer_path, opened)
+        _commit_graphs[path] = (key, opened)
+        return opened
+
+
+def write_commit_graph(
+    nodes: dict[str, graph.Node],
+    blooms: dict[str, bytes] | None = None,
+    base: graph.CommitGraph | None = None,
+) -> None:
+    """
+    Write NODES and their changed-path Bloom filters as the top layer of the
+    commit graph, right above BASE (one of the current graph's layers).
+    Layers above BASE are dropped. Without BASE the commit-graph file itself
+    is replaced and every layer dropped.
+    """
+    layers_dir = _commit_graph_layers_dir()
+    chain = _read_graph_chain()
+    kept: list[str] = []
+    if base is None:
+        # Drop the layers first, they are only valid on top of the old file
+        _write_graph_chain(kept)
+        graph.write_graph(_commit_graph_path(), nodes, blooms)
+    else:
+        if base.path != _commit_graph_path():
+            kept = chain[: chain.index(os.path.basename(base.path)) + 1]
+        name = f"graph-{os.urandom(10).hex()}.graph"
+        graph.write_graph(os.path.join(layers_dir, name), nodes, blooms, base)
+        kept.append(name)
+        _write_graph_chain(kept)
+
+    for name in set(chain) - set(kept):
+        try:
+            os.remove(os.path.join(layers_dir, name))
+        except FileNotFoundError:
+            pass
+
+
+def _read_graph_chain() -> list[str]:
+    try:
+        with open(os.path.join(_commit_graph_layers_dir(), "commit-graph-chain")) as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return []
+
+
+def _write_graph_chain(names: list[str]) -> None:
+    chain_path = os.path.join(_commit_graph_layers_dir(), "commit-graph-chain")
+    if not names:
+        try:
+            os.remove(chain_path)
+        except FileNotFoundError:
+            pass
+        return
+
+    with tempfile.NamedTemporaryFile(
+        "w", dir=_commit_graph_layers_dir(), prefix="tmp-", delete=False
+    ) as tmp:
+        _ = tmp.write("".join(f"{name}\n" for name in names))
+    os.replace(tmp.name, chain_path)
+
+
+def send_pack(out: IO[bytes], oids, progress=None) -> None:
+    """
+    Write a pack stream holding OIDS from the current repository to OUT.
+    No delta search is done here, it would cost far more time than the
+    bandwidth it saves; repack compresses the receiving side later.
+
+    Args: binary file object, OIDs, progress (callable(done, total)) <Optional>
+    Returns: None
+    """
+    _ = pack.write_pack_stream(out, oids, _read_object, progress, window_size=0)
+
+
+def receive_pack(f: IO[bytes], progress=None) -> str | None:
+    """
+    Store a pack stream read from F in the current repository
+
+    Args: binary file object, progress (callable(done, total)) <Optional>
+    Returns: path of the new pack without extension (str) or None if it was empty
+    """
+    pack_dir = os.path.join(git_dir, "objects", "pack")
+    path = pack.index_pack(pack_dir, f, progress)
+    with _packs_lock:
+        # Reopen the pack list on next use, keeping the packs already open
+        cached = _packs.get(pack_dir)
+        if cached is not None:
+            _packs[pack_dir] = (-1, cached[1])
+    return path
+
+
+def get_largest_pack(with_bitmaps: bool = False) -> pack.Pack | None:
+    """
+    Return the pack of the current repository holding the most objects,
+    only looking at packs with reachability bitmaps if WITH_BITMAPS is set.
+    Right after a repack this is the only pack.
+    """
+    packs = [p for p in _get_packs() if p.bitmaps or not with_bitmaps]
+    return max(packs, key=lambda pack_: pack_.count, default=None)
+
+
+def _iter_loose_objects():
+    """
+    Yield the OID of every loose object in either layout
+    """
+    objects_dir = os.path.join(git_dir, "objects")
+    for name in os.listdir(objects_dir):
+        path = os.path.join(objects_dir, name)
+        if len(name) == 40 and os.path.isfile(path):
+            yield name
+        elif len(name) == 2 and os.path.isdir(path):
+            for rest in os.listdir(path):
+                if len(rest) == 38:
+                    yield name + rest
+
+
+def _remove_loose_object(oid: str) -> None:
+    """
+    Delete the loose copy of OID, cleaning up an empty fan-out directory
+    """
+    for path in (_object_path(oid), _legacy_object_path(oid)):
+        if os.path.isfile(path):
+            os.remove(path)
+
+    try:
+        os.rmdir(os.path.dirname(_object_path(oid)))
+    except OSError:
+        pass
+
+
+def repack(reachable: set[str] | None = None, expire_before: float = 0) -> int:
+    """
+    Move every loose and packed object into a single new pack.
+    If REACHABLE is given only those objects are packed. Other loose objects
+    stay where they are, and other packed objects are written out as loose
+    objects carrying the age of their pack, so prune_objects expires each of
+    them on its own schedule. Those from packs last modified before
+    EXPIRE_BEFORE are dropped right away.
+
+    Args: reachable OIDs <Optional>, expire_before (timestamp)
+    Returns: Number of packed objects (int)
+    """
+    pack_dir = os.path.join(git_dir, "objects", "pack")
+    old_packs = _get_packs()
+    loose = set(_iter_loose_objects())
+    oids = set(loose)
+    for pack_ in old_packs:
+        oids.update(pack_)
+    if reachable is not None:
+        oids &= reachable
+
+    new_path = pack.write_pack(pack_dir, sorted(oids), _read_object)
+
+    if reachable is not None:
+        for pack_ in old_packs:
+            mtime = os.stat(pack_.path + ".pack").st_mtime
+            if mtime < expire_before:
+                continue
+            for oid in pack_:
+                if oid not in reachable and oid not in loose:
+                    _write_object(oid, _read_object(oid))
+                    os.utime(_object_path(oid), (mtime, mtime))
+                    loose.add(oid)
+
+    for oid in loose & oids:
+        _remove_loose_object(oid)
+    for pack_ in old_packs:
+        if pack_.path != new_path:
+            os.remove(pack_.path + ".pack")
+            os.remove(pack_.path + ".idx")
+            if os.path.isfile(pack_.path + ".bitmap"):
+                os.remove(pack_.path + ".bitmap")
+    _ = _packs.pop(pack_dir, None)
+
+    return len(oids)
+
+
+def prune_objects(reachable: set[str], expire_before: float) -> int:
+    """
+    Delete loose objects outside REACHABLE, and leftover temporary files,
+    last modified before EXPIRE_BEFORE.
+    Newer files may belong to a write that hasn't been referenced yet.
+
+    Args: reachable OIDs, expire_before (timestamp)
+    Returns: Number of pruned objects (int)
+    """
+    pruned = 0
+    for oid in list(_iter_loose_objects()):
+        if oid in reachable:
+            continue
+        for path in (_object_path(oid), _legacy_object_path(oid)):
+            try:
+                if os.stat(path).st_mtime < expire_before:
+                    os.remove(path)
+                    pruned += 1
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(os.path.dirname(_object_path(oid)))
+        except OSError:
+            pass
+
+    objects_dir = os.path.join(git_dir, "objects")
+    for root, _, filenames in os.walk(objects_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if filename.startswith("tmp") and os.stat(path).st_mtime < expire_before:
+                os.remove(path)
+    return pruned
+
+
+class ObjectStats(NamedTuple):
+    """
+    Number and on-disk size of the loose and packed objects of a repository
+    """
+
+    loose: int
+    loose_bytes: int
+    packs: int
+    packed: int
+    pack_bytes: int
+
+
+def count_objects() -> ObjectStats:
+    """
+    Count the objects of the current repository and the space they take
+
+    Args: None
+    Returns: ObjectStats
+    """
+    loose = 0
+    loose_bytes = 0
+    for oid in _iter_loose_objects():
+        for path in (_object_path(oid), _legacy_object_path(oid)):
+            if os.path.isfile(path):
+                loose += 1
+                loose_bytes += os.path.getsize(path)
+
+    packs = _get_packs()
+    pack_bytes = 0
+    for pack_ in packs:
+        for extension in (".pack", ".idx", ".bitmap"):
+            if os.path.isfile(pack_.path + extension):
+                pack_bytes += os.path.getsize(pack_.path + extension)
+    packed = sum(pack_.count for pack_ in packs)
+    return ObjectStats(loose, loose_bytes, len(packs), packed, pack_bytes)
+
+
+def migrate_objects() -> int:
+    """
+    Convert every object stored in the old flat layout into the fan-out,
+    compressed layout
+
+    Args: None
+    Returns: Number of migrated objects (int)
+    """
+    objects_dir = os.path.join(git_dir, "objects")
+    migrated = 0
+    for name in os.listdir(objects_dir):
+        legacy_location = os.path.join(objects_dir, name)
+        if len(name) != 40 or not os.path.isfile(legacy_location):
+            continue
+        with open(legacy_location, "rb") as f:
+            obj = f.read()
+        if not os.path.isfile(_object_path(name)):
+            _write_object(name, obj)
+        os.remove(legacy_location)
+        migrated += 1
+    return migrated
+
+
 def update_ref(ref: str, value: RefValue, deref: bool = True) -> None:
     """
     Set REF to the OID
@@ -116,11 +916,17 @@ def get_ref(ref: str, deref: bool = True) -> RefValue:
 
 def delete_ref(ref: str, deref: bool = True):
     """
-    Remove the specified ref file.
+    Remove the specified ref, both its file and its packed-refs entry.
     """
     ref = _get_ref_internal(ref, deref)[0]
     path_to_remove = os.path.join(git_dir, ref)
-    os.remove(path_to_remove)
+    names, values = _read_packed_refs()
+    packed = _find_packed_ref(ref) is not None
+    if packed:
+        i = names.index(ref)
+        _write_packed_refs(names[:i] + names[i + 1 :], values[:i] + values[i + 1 :])
+    if os.path.isfile(path_to_remove) or not packed:
+        os.remove(path_to_remove)
 
 
 def _get_ref_internal(ref: str, deref: bool) -> tuple[str, RefValue]:
@@ -133,6 +939,8 @@ def _get_ref_internal(ref: str, deref: bool) -> tuple[str, RefValue]:
     if os.path.isfile(ref_path):
         with open(ref_path, "r") as f:
             value = f.read().strip()
+    else:
+        value = _find_packed_ref(ref)
 
     symbolic: bool = bool(value) and value.startswith("ref:")
     if symbolic and value is not None:
@@ -150,54 +958,476 @@ def iter_refs(prefix: str = "", deref: bool = True):
     Args: deref (bool)
     Returns: None
     """
-    refs: list[str] = ["HEAD", "MERGE_HEAD"]
-
+    loose: set[str] = set()
     for root, _, filenames in os.walk(os.path.join(git_dir, "refs")):
         rel_path = os.path.relpath(root, git_dir)
-        refs.extend(os.path.join(rel_path, filename) for filename in filenames)
+        loose.update(os.path.join(rel_path, filename) for filename in filenames)
+
+    # Packed refs are never symbolic, so unless a loose ref overrides them
+    # their value is already known
+    names, values = _read_packed_refs()
+    packed = {name: oid for name, (oid, _) in zip(names, values) if name not in loose}
 
-    for ref_name in refs:
+    for ref_name in ["HEAD", "MERGE_HEAD", *sorted(loose | packed.keys())]:
         if not ref_name.startswith(prefix):
             continue
+        if ref_name in packed:
+            yield ref_name, RefValue(symbolic=False, value=packed[ref_name])
+            continue
         ref = get_ref(ref_name, deref=deref)
         if ref.value:
             yield ref_name, ref
 
 
-def object_exists(oid):
-    path = os.path.join(git_dir, "objects", oid)
-    return os.path.isfile(path)
+def pack_refs() -> int:
+    """
+    Move every loose ref under refs/ into the packed-refs file, recording
+    the peeled target of refs pointing at tag objects
+
+    Args: None
+    Returns: Number of refs packed (int)
+    """
+    names, values = _read_packed_refs()
+    entries = dict(zip(names, values))
 
+    loose: dict[str, str] = {}
+    for root, _, filenames in os.walk(os.path.join(git_dir, "refs")):
+        rel_path = os.path.relpath(root, git_dir)
+        for filename in filenames:
+            ref_name = os.path.join(rel_path, filename)
+            ref = get_ref(ref_name, deref=False)
+            if ref.value and not ref.symbolic:
+                loose[ref_name] = ref.value
+                entries[ref_name] = (ref.value, _peel(ref.value))
 
-def fetch_object_if_missing(oid, remote_git_dir):
-    if object_exists(oid):
-        return
+    names = sorted(entries)
+    _write_packed_refs(names, [entries[name] for name in names])
+
+    for ref_name, oid in loose.items():
+        # Leave refs alone that were updated while packing
+        if get_ref(ref_name, deref=False).value == oid:
+            os.remove(os.path.join(git_dir, ref_name))
+    return len(loose)
+
+
+def _peel(oid: str) -> str | None:
+    """
+    The object a tag object ultimately points at, or None if OID is not a tag
+    """
+    peeled = None
+    while True:
+        try:
+            type_, _, content = _read_object(oid).partition(b"\x00")
+        except FileNotFoundError:
+            return peeled
+        if type_ != b"tag":
+            return peeled
+        oid = content.split(b"\n", 1)[0].split(b" ", 1)[1].decode()
+        peeled = oid
+
+
+def _read_packed_refs() -> tuple[list[str], list[tuple[str, str | None]]]:
+    """
+    Parse packed-refs into sorted ref names and their (OID, peeled OID).
+    The parsed file is kept in memory until it changes on disk.
+    """
+    path = os.path.join(git_dir, "packed-refs")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return [], []
+
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _packed_refs.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
 
-    remote_git_dir = os.path.join(remote_git_dir, "ugit")
-    from_path = os.path.join(remote_git_dir, "objects", oid)
-    to_path = os.path.join(git_dir, "objects", oid)
+    names: list[str] = []
+    values: list[tuple[str, str | None]] = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("^"):
+                values[-1] = (values[-1][0], line[1:])
+                continue
+            oid, name = line.split(" ", 1)
+            names.append(name)
+            values.append((oid, None))
 
-    shutil.copy(from_path, to_path)
+    _packed_refs[path] = (key, names, values)
+    return names, values
 
 
-def push_object(oid, remote_git_dir):
-    remote_git_dir = os.path.join(remote_git_dir, "ugit")
-    to_path = os.path.join(remote_git_dir, "objects", oid)
-    from_path = os.path.join(git_dir, "objects", oid)
+def _find_packed_ref(ref: str) -> str | None:
+    """
+    Binary search packed-refs for REF
+    """
+    names, values = _read_packed_refs()
+    i = bisect.bisect_left(names, ref)
+    if i < len(names) and names[i] == ref:
+        return values[i][0]
+    return None
+
+
+def _write_packed_refs(names: list[str], values: list[tuple[str, str | None]]) -> None:
+    lines = [PACKED_REFS_HEADER]
+    for name, (oid, peeled) in zip(names, values):
+        lines.append(f"{oid} {name}")
+        if peeled is not None:
+            lines.append(f"^{peeled}")
+
+    with tempfile.NamedTemporaryFile("w", dir=git_dir, delete=False) as tmp:
+        _ = tmp.write("\n".join(lines) + "\n")
+    os.replace(tmp.name, os.path.join(git_dir, "packed-refs"))
+
+
+def find_objects(prefix: str) -> list[str]:
+    """
+    Every stored OID starting with the hex PREFIX (at least 2 characters).
+    Only the fan-out directory the prefix selects is listed, and pack
+    indexes are binary searched, so no full scan of the store is needed.
+
+    Args: prefix (str)
+    Returns: sorted list[str]
+    """
+    prefix = prefix.lower()
+    assert len(prefix) >= 2, "OID prefixes need at least 2 characters"
+
+    found: set[str] = set()
+    for objects_dir in _object_dirs():
+        for directory in (os.path.join(objects_dir, prefix[:2]), objects_dir):
+            oids = _list_loose_oids(directory)
+            i = bisect.bisect_left(oids, prefix)
+            while i < len(oids) and oids[i].startswith(prefix):
+                found.add(oids[i])
+                i += 1
+        for pack_ in _get_packs(objects_dir):
+            found.update(pack_.iter_prefix(prefix))
+    return sorted(found)
+
+
+def _list_loose_oids(directory: str) -> list[str]:
+    """
+    Sorted OIDs of the loose objects in DIRECTORY, either a fan-out
+    directory or an objects directory holding the flat layout.
+    The listing is kept until the directory changes.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+    cached = _loose_oids.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    fanout = os.path.basename(directory)
+    if len(fanout) != 2 or not _is_hex(fanout):
+        fanout = ""
+    oids = sorted(
+        fanout + name
+        for name in os.listdir(directory)
+        if len(fanout + name) == 40 and _is_hex(name)
+    )
+    _loose_oids[directory] = (mtime, oids)
+    return oids
+
+
+def _is_hex(name: str) -> bool:
+    return all(c in "0123456789abcdef" for c in name)
+
+
+def object_exists(oid: str) -> bool:
+    """
+    Check whether OID is stored in either loose object layout or in a pack,
+    here or in one of the alternates
+    """
+    for objects_dir in _object_dirs():
+        if os.path.isfile(_object_path(oid, objects_dir)):
+            return True
+        if os.path.isfile(_legacy_object_path(oid, objects_dir)):
+            return True
+        if any(oid in pack_ for pack_ in _get_packs(objects_dir)):
+            return True
+    return False
+
+
+class IndexEntry(NamedTuple):
+    """
+    A staged file: its blob OID plus the stat data recorded when it was
+    last hashed or checked out. Zeroed stat data never matches a file.
+    """
+
+    oid: str
+    mode: int = 0
+    size: int = 0
+    mtime_ns: int = 0
+    ctime_ns: int = 0
+    inode: int = 0
+
+
+class Index(dict):
+    """
+    path -> IndexEntry mapping that also carries the cache tree: the tree OID
+    of every directory ("" for the root) whose entries haven't changed since
+    its tree was last written. Changing an entry's OID, adding or removing it
+    invalidates the cached trees along its path.
+
+    MTIME_NS is the modification time of the index file the entries were
+    read from. Entries modified at or after it are racy: the file may have
+    changed again within the same timestamp, so their stat data proves
+    nothing.
+    """
+
+    def __init__(
+        self,
+        *args,
+        cache_tree: dict[str, str] | None = None,
+        mtime_ns: int = 0,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.cache_tree: dict[str, str] = dict(cache_tree or {})
+        self.mtime_ns = mtime_ns
+
+    def __setitem__(self, path: str, entry: IndexEntry) -> None:
+        old = self.get(path)
+        if old is None or old.oid != entry.oid:
+            self.invalidate(path)
+        super().__setitem__(path, entry)
+
+    def __delitem__(self, path: str) -> None:
+        self.invalidate(path)
+        super().__delitem__(path)
+
+    def pop(self, path: str, *default):
+        if path in self:
+            self.invalidate(path)
+        return super().pop(path, *default)
+
+    def update(self, *args, **kwargs) -> None:
+        for path, entry in dict(*args, **kwargs).items():
+            self[path] = entry
+
+    def clear(self) -> None:
+        super().clear()
+        self.cache_tree.clear()
+
+    def copy(self) -> "Index":
+        return Index(self, cache_tree=self.cache_tree, mtime_ns=self.mtime_ns)
+
+    def is_racy(self, entry: IndexEntry) -> bool:
+        """
+        Whether ENTRY was recorded too close to the index write to be
+        trusted by its stat data alone
+        """
+        return self.mtime_ns != 0 and entry.mtime_ns >= self.mtime_ns
 
-    shutil.copy(from_path, to_path)
+    def invalidate(self, path: str) -> None:
+        """
+        Drop the cached tree of every directory containing PATH
+        """
+        parent = os.path.dirname(path)
+        while True:
+            _ = self.cache_tree.pop(parent, None)
+            if not parent:
+                return
+            parent = os.path.dirname(parent)
+
+
+INDEX_SIGNATURE = b"UIND"
+INDEX_VERSION = 1
+
+_INDEX_HEADER = struct.Struct(">4sII")
+_INDEX_ENTRY = struct.Struct(">20sIQqqQH")
+_INDEX_EXTENSION = struct.Struct(">4sI")
+_CACHE_TREE_ENTRY = struct.Struct(">20sH")
+CACHE_TREE_SIGNATURE = b"TREE"
+
+# (stat key, index) of the last index read or written
+_index_cache: tuple[tuple[str, int, int, int], Index] | None = None
+
+
+def index_entry(path: str, oid: str, st: os.stat_result | None = None) -> IndexEntry:
+    """
+    Build an index entry for PATH holding OID using the file's current stat data
+    """
+    if st is None:
+        st = os.stat(path)
+    return IndexEntry(
+        oid=oid,
+        mode=st.st_mode,
+        size=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        ctime_ns=st.st_ctime_ns,
+        inode=st.st_ino,
+    )
+
+
+def stat_matches(index: Index, path: str, st: os.stat_result) -> bool:
+    """
+    Check whether the file behind ST is unchanged since its INDEX entry for
+    PATH was recorded. Racy entries never match, so they get re-hashed.
+    """
+    entry = index.get(path)
+    return (
+        entry is not None
+        and entry.mtime_ns != 0
+        and not index.is_racy(entry)
+        and entry.mtime_ns == st.st_mtime_ns
+        and entry.ctime_ns == st.st_ctime_ns
+        and entry.size == st.st_size
+        and entry.inode == st.st_ino
+        and entry.mode == st.st_mode
+    )
 
 
 @contextmanager
 def get_index():
-    index: dict[str, str] = {}
+    """
+    Yield the index as an Index of path -> IndexEntry.
+    The index is only written back if its entries or cache tree changed.
+    """
+    index = _read_index()
+    original = index.copy()
+
+    yield index
+
+    if index != original or index.cache_tree != original.cache_tree:
+        _write_index(index, original)
+
+
+def _index_key(index_location: str) -> tuple[str, int, int, int] | None:
+    try:
+        st = os.stat(index_location)
+    except FileNotFoundError:
+        return None
+    return index_location, st.st_mtime_ns, st.st_size, st.st_ino
+
 
+def _read_index() -> Index:
+    """
+    Parse the memory mapped binary index (or an old JSON index)
+    """
+    global _index_cache
     index_location = os.path.join(git_dir, "index")
-    if os.path.isfile(index_location):
-        with open(index_location) as f:
-            index = json.load(f)
+    key = _index_key(index_location)
+    if key is None:
+        return Index()
+    if _index_cache is not None and _index_cache[0] == key:
+        return _index_cache[1].copy()
+
+    _, index_mtime_ns, _, _ = key
+    with open(index_location, "rb") as f:
+        if f.read(1) == b"{":
+            f.seek(0)
+            index = Index(
+                ((path, IndexEntry(oid)) for path, oid in json.load(f).items()),
+                mtime_ns=index_mtime_ns,
+            )
+            _index_cache = (key, index)
+            return index.copy()
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with buffer:
+        body_end = len(buffer) - 20
+        assert (
+            hashlib.sha1(buffer[:body_end]).digest() == buffer[body_end:]
+        ), "Index checksum mismatch"
+        signature, version, count = _INDEX_HEADER.unpack_from(buffer, 0)
+        assert signature == INDEX_SIGNATURE, "Bad index signature"
+        assert version == INDEX_VERSION, f"Unsupported index version {version}"
+
+        index = Index(mtime_ns=index_mtime_ns)
+        pos = _INDEX_HEADER.size
+        for _ in range(count):
+            oid, mode, size, mtime_ns, ctime_ns, inode, path_length = (
+                _INDEX_ENTRY.unpack_from(buffer, pos)
+            )
+            pos += _INDEX_ENTRY.size
+            path = buffer[pos : pos + path_length].decode()
+            pos += path_length
+            index[path] = IndexEntry(oid.hex(), mode, size, mtime_ns, ctime_ns, inode)
+
+        # Extensions: signature, length, data. Unknown ones are skipped.
+        while pos < body_end:
+            signature, length = _INDEX_EXTENSION.unpack_from(buffer, pos)
+            pos += _INDEX_EXTENSION.size
+            if signature == CACHE_TREE_SIGNATURE:
+                index.cache_tree.update(_parse_cache_tree(buffer, pos, pos + length))
+            pos += length
+
+    _index_cache = (key, index)
+    return index.copy()
+
+
+def _parse_cache_tree(buffer, pos: int, end: int) -> dict[str, str]:
+    cache_tree: dict[str, str] = {}
+    while pos < end:
+        oid, path_length = _CACHE_TREE_ENTRY.unpack_from(buffer, pos)
+        pos += _CACHE_TREE_ENTRY.size
+        cache_tree[buffer[pos : pos + path_length].decode()] = oid.hex()
+        pos += path_length
+    return cache_tree
 
-    yield index
 
-    with open(index_location, "w") as f:
-        json.dump(index, f)
+def _encode_cache_tree(cache_tree: dict[str, str]) -> bytes:
+    parts = []
+    for path in sorted(cache_tree):
+        encoded_path = path.encode()
+        parts.append(
+            _CACHE_TREE_ENTRY.pack(bytes.fromhex(cache_tree[path]), len(encoded_path))
+        )
+        parts.append(encoded_path)
+    return b"".join(parts)
+
+
+def _write_index(index: Index, original: Index) -> None:
+    """
+    Write the index as sorted binary entries followed by a SHA-1 checksum.
+    ORIGINAL is the index as it was read, before any changes.
+    """
+    global _index_cache
+    index_location = os.path.join(git_dir, "index")
+
+    parts = [_INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(index))]
+    for path in sorted(index):
+        entry = index[path]
+        if original.is_racy(entry) and original.get(path) == entry:
+            # A racy entry nobody re-checked would look clean next to the
+            # newer index file, so force a re-hash instead
+            entry = entry._replace(mtime_ns=0)
+            index[path] = entry
+        encoded_path = path.encode()
+        parts.append(
+            _INDEX_ENTRY.pack(
+                bytes.fromhex(entry.oid),
+                entry.mode,
+                entry.size,
+                entry.mtime_ns,
+                entry.ctime_ns,
+                entry.inode,
+                len(encoded_path),
+            )
+        )
+        parts.append(encoded_path)
+
+    if index.cache_tree:
+        cache_tree = _encode_cache_tree(index.cache_tree)
+        parts.append(_INDEX_EXTENSION.pack(CACHE_TREE_SIGNATURE, len(cache_tree)))
+        parts.append(cache_tree)
+
+    body = b"".join(parts)
+    with tempfile.NamedTemporaryFile(dir=git_dir, delete=False) as tmp:
+        _ = tmp.write(body)
+        _ = tmp.write(hashlib.sha1(body).digest())
+    os.replace(tmp.name, index_location)
+
+    key = _index_key(index_location)
+    if key is None:
+        _index_cache = None
+        return
+    index.mtime_ns = key[1]
+    _index_cache = (key, index.copy())
@@ -1,61 +1,86 @@
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-import difflib
+import itertools
+import os
 from . import data
+from . import diffalgo
 
+# Threads used to diff blob pairs
+DIFF_WORKERS = min(32, (os.cpu_count() or 1) + 4)
 
-def compare_trees(*trees: dict[str, str]):
-    """
-    Takes in any number of trees (dictionary of path and oid for all files in tree) and yields the path and oids for all the trees
-    """
-    entries: defaultdict[str, list[None | str]] = defaultdict(
-        lambda: [None] * len(trees)
-    )
-    for i, tree in enumerate(trees):
-        for path, oid in tree.items():
-            entries[path][i] = oid
+# Changed files whose blobs are fetched together in a partial clone
+PREFETCH_BATCH = 256
 
-    for path, oids in entries.items():
-        yield (path, *oids)
+# Workers used to merge conflicting blobs, processes once there are enough
+MERGE_WORKERS = os.cpu_count() or 1
+MERGE_PROCESS_MIN_CONFLICTS = 16
 
 
-def diff_trees(t_from: dict[str, str], t_to: dict[str, str]):
+def iter_diff_changes(changes):
     """
-    Compares 2 trees, if they have the same path, compare oid
+    Yield the diff of every modified file in CHANGES, an ordered iterable of
+    (path, o_from, o_to) such as base.iter_tree_changes produces.
+    Blob pairs are diffed on a thread pool, at most a few files ahead of
+    the consumer so memory stays bounded.
     """
-    output = ""
-    for path, o_from, o_to in compare_trees(t_from, t_to):
-        _ = path
-        if o_from != o_to and o_from is not None and o_to is not None:
-            # output += f"changed: {path}\n"
-            output += diff_blobs(o_from, o_to)
-    return output
-
-
-def diff_blobs(t_from: str, t_to: str) -> str:
+    modified = (
+        (path, o_from, o_to)
+        for path, o_from, o_to in changes
+        if o_from != o_to and o_from is not None and o_to is not None
+    )
+    with ThreadPoolExecutor(DIFF_WORKERS) as executor:
+        pending: deque[Future[str]] = deque()
+        while batch := list(itertools.islice(modified, PREFETCH_BATCH)):
+            # Blobs left behind by a partial fetch arrive in one request
+            _ = data.prefetch_objects(oid for _, *oids in batch for oid in oids)
+            for path, o_from, o_to in batch:
+                if len(pending) >= 2 * DIFF_WORKERS:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(diff_blobs, o_from, o_to, path))
+        while pending:
+            yield pending.popleft().result()
+
+
+def diff_blobs(t_from: str, t_to: str, path: str | None = None) -> str:
     """
     Display the difference between 2 files
+    PATH is used for the a/ and b/ headers and to read working tree files
+    that were never stored as objects
 
-    Args: OIDs of files
+    Args: OIDs of files, path (str)
     Returns: str output
     """
-    data_from = data.get_object(t_from).decode()
-    data_to = data.get_object(t_to).decode()
+    data_from = _read_blob(t_from, path).decode()
+    data_to = _read_blob(t_to, path).decode()
 
     lines1 = data_from.splitlines()
     lines2 = data_to.splitlines()
 
-    diff = difflib.unified_diff(
-        lines1, lines2, fromfile="Previous", tofile="New", lineterm=""
-    )
-    return "\n".join(diff)
+    name = path if path is not None else t_from
+    diff = diffalgo.unified_diff(lines1, lines2, f"a/{name}", f"b/{name}")
+    return "".join(f"{line}\n" for line in diff)
 
 
-def iter_changed_files(t_from, t_to):
+def _read_blob(oid: str, path: str | None) -> bytes:
     """
-    Yield the files that differ between the two trees with a descriptive action.
+    Read a blob from the object store, or from the working tree file at PATH
+    when the scanner only computed its OID
     """
-    for path, o_from, o_to in compare_trees(t_from, t_to):
+    try:
+        return data.get_object(oid)
+    except FileNotFoundError:
+        if path is None:
+            raise
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def iter_changed_actions(changes):
+    """
+    Yield (path, action) for every (path, o_from, o_to) in CHANGES that differs.
+    """
+    for path, o_from, o_to in changes:
         if o_from != o_to:
             action = (
                 "New File " if not o_from else "Deleted " if not o_to else "modified"
@@ -70,10 +95,9 @@ def diff_DHEAD(head_text: str, other_text: str, macro="HEAD"):
     head_lines = head_text.splitlines(keepends=True)
     other_lines = other_text.splitlines(keepends=True)
 
-    sm = difflib.SequenceMatcher(None, head_lines, other_lines)
     output = []
 
-    for op, i1, i2, j1, j2 in sm.get_opcodes():
+    for op, i1, i2, j1, j2 in diffalgo.get_opcodes(head_lines, other_lines):
         if op == "equal":
             output.extend(head_lines[i1:i2])
         elif op == "replace":
@@ -112,6 +136,7 @@ def diff3_merge(
     label_head="HEAD",
     label_base="BASE",
     label_other="MERGE_HEAD",
+    algorithm: str | None = None,
 ) -> str:
     """
     Pure Python 3-way merge (replacement for `diff3 -m`).
@@ -122,19 +147,16 @@ def diff3_merge(
     head = head_text.splitlines(keepends=True)
     other = other_text.splitlines(keepends=True)
 
-    sm_head = difflib.SequenceMatcher(None, base, head)
-    sm_other = difflib.SequenceMatcher(None, base, other)
-
-    def collect_changes(sm: difflib.SequenceMatcher, seq: list[str]) -> list[_Change]:
+    def collect_changes(seq: list[str]) -> list[_Change]:
         changes: list[_Change] = []
-        for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        for tag, i1, i2, j1, j2 in diffalgo.get_opcodes(base, seq, algorithm):
             if tag == "equal":
                 continue
             changes.append(_Change(i1, i2, seq[j1:j2]))
         return changes
 
-    head_changes = collect_changes(sm_head, head)
-    other_changes = collect_changes(sm_other, other)
+    head_changes = collect_changes(head)
+    other_changes = collect_changes(other)
 
     def materialize(
         changes: list[_Change], start: int, end: int, fallback: list[str]
@@ -232,22 +254,16 @@ def diff3_merge(
     return "".join(output)
 
 
-def merge_trees(t_base, t_head, t_other):
-    """
-    Run a three-way merge across tree dictionaries and return the merged tree.
-    """
-    tree = {}
-    for path, o_base, o_head, o_other in compare_trees(t_base, t_head, t_other):
-        blob = merge_blobs(o_base, o_head, o_other)
-        if blob is None:
-            continue
-        tree[path] = data.hash_object(blob)
-    return tree
-
-
-def merge_blobs(o_base: str | None, o_head: str | None, o_other: str | None):
+def merge_blobs(
+    o_base: str | None,
+    o_head: str | None,
+    o_other: str | None,
+    algorithm: str | None = None,
+):
     """
     Merge three blob IDs and return conflict-marked content if needed.
+    A missing base (the file was added on both sides) merges against an
+    empty file.
     """
     if o_head is None and o_other is None and o_base is None:
         return None
@@ -258,13 +274,47 @@ def merge_blobs(o_base: str | None, o_head: str | None, o_other: str | None):
     if o_other is None:
         return data.get_object(o_head)
 
-    if o_base is None:
-        return data.get_object(o_base) if o_base is not None else None
-
     head = data.get_object(o_head).decode()
     other = data.get_object(o_other).decode()
-    base = data.get_object(o_base).decode()
+    base = data.get_object(o_base).decode() if o_base is not None else ""
 
     # result = diff_DHEAD(a, b)
-    result = diff3_merge(base, head, other)
+    result = diff3_merge(base, head, other, algorithm=algorithm)
     return result.encode()
+
+
+def merge_conflicting_blobs(conflicts) -> dict[str, str]:
+    """
+    Run diff3 on every (path, o_base, o_head, o_other) where both sides
+    changed the blob, and store the results.
+    Merges run on a process pool when there are enough of them, since
+    diff3 is pure Python.
+
+    Returns: dict[path, merged blob OID]
+    """
+    if len(conflicts) >= MERGE_PROCESS_MIN_CONFLICTS:
+        executor = ProcessPoolExecutor(
+            MERGE_WORKERS, initializer=data.set_git_dir, initargs=(data.git_dir,)
+        )
+    else:
+        executor = ThreadPoolExecutor(MERGE_WORKERS)
+
+    with executor:
+        oids = executor.map(
+            _merge_blob_worker,
+            [diffalgo.default] * len(conflicts),
+            *zip(
+                *[(o_base, o_head, o_other) for _, o_base, o_head, o_other in conflicts]
+            ),
+        )
+        return {conflict[0]: oid for conflict, oid in zip(conflicts, oids)}
+
+
+def _merge_blob_worker(
+    algorithm: str, o_base: str | None, o_head: str, o_other: str
+) -> str:
+    """
+    Merge one blob with ALGORITHM and store the result. Worker processes
+    don't see the --diff-algorithm option, so it is passed along.
+    """
+    return data.hash_object(merge_blobs(o_base, o_head, o_other, algorithm))
@@ -0,0 +1,437 @@
+import difflib
+from collections import defaultdict
+from collections.abc import Iterator, Sequence
+
+ALGORITHMS = ("histogram", "myers", "patience", "difflib")
+
+# Algorithm used when none is given, set by the --diff-algorithm option
+default = "histogram"
+
+# Lines occurring more often than this are not used as histogram anchors
+MAX_CHAIN = 64
+
+Opcode = tuple[str, int, int, int, int]
+
+
+def get_opcodes(
+    a: Sequence[str], b: Sequence[str], algorithm: str | None = None
+) -> list[Opcode]:
+    """
+    Same as difflib.SequenceMatcher(None, a, b).get_opcodes(), computed
+    with the chosen algorithm.
+    Lines are interned into integers and common prefixes and suffixes are
+    trimmed before matching.
+
+    Args: lines of both sides, algorithm (str) <Optional>
+    Returns: list of (tag, i1, i2, j1, j2)
+    """
+    algorithm = algorithm or default
+    if algorithm == "difflib":
+        return difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+    a_ids, b_ids = _intern(a, b)
+    matches: list[tuple[int, int]] = []
+    if algorithm == "myers":
+        _myers(a_ids, b_ids, 0, len(a), 0, len(b), matches)
+    elif algorithm == "histogram":
+        _histogram(a_ids, b_ids, 0, len(a), 0, len(b), matches)
+    elif algorithm == "patience":
+        _patience(a_ids, b_ids, 0, len(a), 0, len(b), matches)
+    else:
+        assert False, f"Unknown diff algorithm {algorithm}"
+
+    matches.sort()
+    return _opcodes_from_matches(matches, len(a), len(b))
+
+
+def unified_diff(
+    a: Sequence[str],
+    b: Sequence[str],
+    fromfile: str = "",
+    tofile: str = "",
+    n: int = 3,
+    algorithm: str | None = None,
+) -> Iterator[str]:
+    """
+    Same output as difflib.unified_diff(a, b, fromfile, tofile, n=n, lineterm="")
+    """
+    started = False
+    for group in _group_opcodes(get_opcodes(a, b, algorithm), n):
+        if not started:
+            started = True
+            yield f"--- {fromfile}"
+            yield f"+++ {tofile}"
+        first, last = group[0], group[-1]
+        file1_range = _format_range(first[1], last[2])
+        file2_range = _format_range(first[3], last[4])
+        yield f"@@ -{file1_range} +{file2_range} @@"
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield " " + line
+                continue
+            if tag in ("replace", "delete"):
+                for line in a[i1:i2]:
+                    yield "-" + line
+            if tag in ("replace", "insert"):
+                for line in b[j1:j2]:
+                    yield "+" + line
+
+
+def _intern(a: Sequence[str], b: Sequence[str]) -> tuple[list[int], list[int]]:
+    ids: dict[str, int] = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    return a_ids, b_ids
+
+
+def _trim(
+    a: list[int],
+    b: list[int],
+    alo: int,
+    ahi: int,
+    blo: int,
+    bhi: int,
+    matches: list[tuple[int, int]],
+) -> tuple[int, int, int, int]:
+    """
+    Record the common prefix and suffix of both ranges as matches and
+    return the remaining ranges
+    """
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        matches.append((ahi, bhi))
+    return alo, ahi, blo, bhi
+
+
+def _myers(
+    a: list[int],
+    b: list[int],
+    alo: int,
+    ahi: int,
+    blo: int,
+    bhi: int,
+    matches: list[tuple[int, int]],
+) -> None:
+    """
+    Myers' O(ND) diff in linear space: find the middle of the shortest edit
+    path from both ends, then solve the two halves. An explicit stack keeps
+    long inputs from hitting the recursion limit.
+    """
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        alo, ahi, blo, bhi = _trim(a, b, *stack.pop(), matches)
+        if alo == ahi or blo == bhi:
+            continue
+        x, y = _middle(a, b, alo, ahi, blo, bhi)
+        stack.append((alo, alo + x, blo, blo + y))
+        stack.append((alo + x, ahi, blo + y, bhi))
+
+
+def _middle(
+    a: list[int], b: list[int], alo: int, ahi: int, blo: int, bhi: int
+) -> tuple[int, int]:
+    """
+    Find a point (x, y) on a shortest edit path by running the forward and
+    backward searches until they overlap. Only two diagonal vectors are kept.
+    """
+    n = ahi - alo
+    m = bhi - blo
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    forward = [-1] * (2 * max_d + 2)
+    backward = [-1] * (2 * max_d + 2)
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    delta = n - m
+    front = delta % 2 != 0
+    k1_start = k1_end = k2_start = k2_end = 0
+
+    for d in range(max_d):
+        for k1 in range(-d + k1_start, d + 1 - k1_end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (
+                k1 != d and forward[k1_offset - 1] < forward[k1_offset + 1]
+            ):
+                x1 = forward[k1_offset + 1]
+            else:
+                x1 = forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            forward[k1_offset] = x1
+            if x1 > n:
+                k1_end += 2
+            elif y1 > m:
+                k1_start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < len(backward) and backward[k2_offset] != -1:
+                    if x1 >= n - backward[k2_offset]:
+                        return x1, y1
+
+        for k2 in range(-d + k2_start, d + 1 - k2_end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (
+                k2 != d and backward[k2_offset - 1] < backward[k2_offset + 1]
+            ):
+                x2 = backward[k2_offset + 1]
+            else:
+                x2 = backward[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            backward[k2_offset] = x2
+            if x2 > n:
+                k2_end += 2
+            elif y2 > m:
+                k2_start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < len(forward) and forward[k1_offset] != -1:
+                    x1 = forward[k1_offset]
+                    y1 = offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return x1, y1
+
+    # Nothing in common: any split point works
+    return n, 0
+
+
+def _histogram(
+    a: list[int],
+    b: list[int],
+    alo: int,
+    ahi: int,
+    blo: int,
+    bhi: int,
+    matches: list[tuple[int, int]],
+) -> None:
+    """
+    Histogram diff: anchor on the longest common run around the line that
+    is rarest across both sides, then solve both sides of the anchor.
+    Regions without a usable anchor fall back to Myers.
+    """
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        alo, ahi, blo, bhi = _trim(a, b, *stack.pop(), matches)
+        if alo == ahi or blo == bhi:
+            continue
+
+        positions: defaultdict[int, list[int]] = defaultdict(list)
+        for i in range(alo, ahi):
+            positions[a[i]].append(i)
+        b_counts: defaultdict[int, int] = defaultdict(int)
+        for j in range(blo, bhi):
+            b_counts[b[j]] += 1
+
+        best = None
+        best_count = 2 * MAX_CHAIN + 1
+        j = blo
+        while j < bhi:
+            candidates = positions.get(b[j])
+            if not candidates:
+                j += 1
+                continue
+            # A line is only a good anchor if it is rare on both sides
+            count = len(candidates) + b_counts[b[j]]
+            if count > best_count or len(candidates) > MAX_CHAIN:
+                j += 1
+                continue
+            next_j = j + 1
+            for i in candidates:
+                # The run is as rare as its rarest line
+                run_count = count
+                start_i, start_j = i, j
+                while (
+                    start_i > alo and start_j > blo and a[start_i - 1] == b[start_j - 1]
+                ):
+                    start_i -= 1
+                    start_j -= 1
+                    line = a[start_i]
+                    run_count = min(run_count, len(positions[line]) + b_counts[line])
+                end_i, end_j = i + 1, j + 1
+                while end_i < ahi and end_j < bhi and a[end_i] == b[end_j]:
+                    line = a[end_i]
+                    run_count = min(run_count, len(positions[line]) + b_counts[line])
+                    end_i += 1
+                    end_j += 1
+                next_j = max(next_j, end_j)
+                if (
+                    best is None
+                    or run_count < best_count
+                    or (run_count == best_count and end_i - start_i > best[2] - best[0])
+                ):
+                    best = (start_i, start_j, end_i, end_j)
+                    best_count = run_count
+            j = next_j
+
+        if best is None:
+            _myers(a, b, alo, ahi, blo, bhi, matches)
+            continue
+
+        start_i, start_j, end_i, end_j = best
+        matches.extend(zip(range(start_i, end_i), range(start_j, end_j)))
+        stack.append((alo, start_i, blo, start_j))
+        stack.append((end_i, ahi, end_j, bhi))
+
+
+def _patience(
+    a: list[int],
+    b: list[int],
+    alo: int,
+    ahi: int,
+    blo: int,
+    bhi: int,
+    matches: list[tuple[int, int]],
+) -> None:
+    """
+    Patience diff: match lines that are unique on both sides in the longest
+    increasing order, then solve the gaps between them. Gaps without unique
+    lines fall back to Myers.
+    """
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        alo, ahi, blo, bhi = _trim(a, b, *stack.pop(), matches)
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = _unique_lcs(a, b, alo, ahi, blo, bhi)
+        if not anchors:
+            _myers(a, b, alo, ahi, blo, bhi, matches)
+            continue
+
+        prev_i, prev_j = alo, blo
+        for i, j in anchors:
+            matches.append((i, j))
+            stack.append((prev_i, i, prev_j, j))
+            prev_i, prev_j = i + 1, j + 1
+        stack.append((prev_i, ahi, prev_j, bhi))
+
+
+def _unique_lcs(
+    a: list[int], b: list[int], alo: int, ahi: int, blo: int, bhi: int
+) -> list[tuple[int, int]]:
+    """
+    Longest increasing sequence of (i, j) pairs of lines unique on both sides
+    """
+    a_count: dict[int, int] = defaultdict(int)
+    a_index: dict[int, int] = {}
+    for i in range(alo, ahi):
+        a_count[a[i]] += 1
+        a_index[a[i]] = i
+    b_count: dict[int, int] = defaultdict(int)
+    b_index: dict[int, int] = {}
+    for j in range(blo, bhi):
+        b_count[b[j]] += 1
+        b_index[b[j]] = j
+
+    pairs = sorted(
+        (b_index[line], a_index[line])
+        for line in b_index
+        if b_count[line] == 1 and a_count.get(line) == 1
+    )
+
+    # Patience sorting over the A positions, in B order
+    tails: list[int] = []
+    tail_pairs: list[int] = []
+    previous: list[int] = [-1] * len(pairs)
+    for index, (_, i) in enumerate(pairs):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < i:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo:
+            previous[index] = tail_pairs[lo - 1]
+        if lo == len(tails):
+            tails.append(i)
+            tail_pairs.append(index)
+        else:
+            tails[lo] = i
+            tail_pairs[lo] = index
+
+    result = []
+    index = tail_pairs[-1] if tail_pairs else -1
+    while index != -1:
+        j, i = pairs[index]
+        result.append((i, j))
+        index = previous[index]
+    result.reverse()
+    return result
+
+
+def _opcodes_from_matches(
+    matches: list[tuple[int, int]], len_a: int, len_b: int
+) -> list[Opcode]:
+    """
+    Turn sorted matching line pairs into SequenceMatcher style opcodes
+    """
+    blocks: list[list[int]] = []
+    for i, j in matches:
+        if (
+            blocks
+            and blocks[-1][0] + blocks[-1][2] == i
+            and blocks[-1][1] + blocks[-1][2] == j
+        ):
+            blocks[-1][2] += 1
+        else:
+            blocks.append([i, j, 1])
+    blocks.append([len_a, len_b, 0])
+
+    opcodes: list[Opcode] = []
+    i = j = 0
+    for ai, bj, size in blocks:
+        if i < ai and j < bj:
+            opcodes.append(("replace", i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(("delete", i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(("insert", i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(("equal", ai, i, bj, j))
+    return opcodes
+
+
+def _group_opcodes(opcodes: list[Opcode], n: int) -> Iterator[list[Opcode]]:
+    """
+    Same as SequenceMatcher.get_grouped_opcodes: hunks with N lines of context
+    """
+    codes = list(opcodes) or [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group: list[Opcode] = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start: int, stop: int) -> str:
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
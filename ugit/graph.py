@@ -0,0 +1,243 @@
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import Iterator
+from typing import NamedTuple
+
+GRAPH_SIGNATURE = b"UCGR"
+VERSION = 2
+
+# Parent slots hold an index into the OID table, or one of these
+NO_PARENT = 0x7FFFFFFF
+EXTRA_EDGES = 0x80000000
+
+_HEADER = struct.Struct(">4sIII")
+_FANOUT = struct.Struct(">256I")
+_RECORD = struct.Struct(">20sIII")
+_EDGE = struct.Struct(">I")
+
+
+class Node(NamedTuple):
+    """
+    A commit as stored in the commit graph: root tree, parents and
+    generation number (1 for root commits, otherwise one more than the
+    highest parent generation).
+    """
+
+    tree: str
+    parents: list[str]
+    generation: int
+
+
+class CommitGraph:
+    """
+    Read-only, memory mapped view of a commit-graph file.
+
+    A graph can be a layer on top of BASE, another CommitGraph holding older
+    commits. Parent positions then count the commits of every layer below
+    first, so a layer is written without touching the layers under it.
+
+    Layout:
+        header   "UCGR", version, commit count, extra edge count
+        fan-out  256 cumulative counts by first OID byte
+        oids     sorted binary OIDs (20 bytes each)
+        records  tree OID (20 bytes), first parent, second parent,
+                 generation (4 bytes each) in OID order
+        edges    parents after the first of octopus merges, the second
+                 parent slot points here with EXTRA_EDGES set and the
+                 last edge of a list has EXTRA_EDGES set
+        blooms   (version 2) end offset of each commit's changed-path Bloom
+                 filter (4 bytes each) in OID order, then the filters.
+                 An empty filter means none was computed.
+    """
+
+    def __init__(self, path: str, base: "CommitGraph | None" = None):
+        self.path = path
+        self.base = base
+        # Commits in the layers below this one
+        self.offset = base.offset + base.count if base is not None else 0
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, self.count, edges = _HEADER.unpack_from(self._map, 0)
+        assert signature == GRAPH_SIGNATURE, f"Bad commit graph signature in {path}"
+        assert version in (1, VERSION), f"Unsupported commit graph version {version}"
+        self._fanout = _FANOUT.unpack_from(self._map, _HEADER.size)
+        self._oids_start = _HEADER.size + _FANOUT.size
+        self._records_start = self._oids_start + 20 * self.count
+        self._edges_start = self._records_start + _RECORD.size * self.count
+        self._blooms_start = None
+        if version >= 2:
+            self._blooms_start = self._edges_start + _EDGE.size * edges
+
+    def close(self) -> None:
+        self._map.close()
+        if self.base is not None:
+            self.base.close()
+
+    def _oid_at(self, i: int) -> str:
+        start = self._oids_start + 20 * i
+        return self._map[start : start + 20].hex()
+
+    def _parent_at(self, position: int) -> str:
+        """
+        OID at a position counted across this layer and the ones below
+        """
+        layer = self
+        while position < layer.offset:
+            assert layer.base is not None
+            layer = layer.base
+        return layer._oid_at(position - layer.offset)
+
+    def position(self, oid: str) -> int | None:
+        """
+        Position of OID counted across this layer and the ones below
+        """
+        layer, i = self._layer_of(oid)
+        if layer is None or i is None:
+            return None
+        return layer.offset + i
+
+    def _layer_of(self, oid: str) -> "tuple[CommitGraph, int] | tuple[None, None]":
+        layer: CommitGraph | None = self
+        while layer is not None:
+            i = layer._find(oid)
+            if i is not None:
+                return layer, i
+            layer = layer.base
+        return None, None
+
+    def _find(self, oid: str) -> int | None:
+        key = bytes.fromhex(oid)
+        lo = self._fanout[key[0] - 1] if key[0] else 0
+        hi = self._fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._oids_start + 20 * mid
+            found = self._map[start : start + 20]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def __contains__(self, oid: str) -> bool:
+        return self.position(oid) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        if self.base is not None:
+            yield from self.base
+        yield from self.iter_layer()
+
+    def iter_layer(self) -> Iterator[str]:
+        """
+        Yield the OIDs stored in this layer only
+        """
+        for i in range(self.count):
+            yield self._oid_at(i)
+
+    def get(self, oid: str) -> Node | None:
+        """
+        Return the graph node for OID or None if it is not in the graph
+        """
+        layer, i = self._layer_of(oid)
+        if layer is None or i is None:
+            return None
+        tree, first, second, generation = _RECORD.unpack_from(
+            layer._map, layer._records_start + _RECORD.size * i
+        )
+
+        parents = []
+        if first != NO_PARENT:
+            parents.append(layer._parent_at(first))
+        if second & EXTRA_EDGES:
+            edge = second & ~EXTRA_EDGES
+            while True:
+                (value,) = _EDGE.unpack_from(layer._map, layer._edges_start + 4 * edge)
+                parents.append(layer._parent_at(value & ~EXTRA_EDGES))
+                if value & EXTRA_EDGES:
+                    break
+                edge += 1
+        elif second != NO_PARENT:
+            parents.append(layer._parent_at(second))
+
+        return Node(tree=tree.hex(), parents=parents, generation=generation)
+
+    def get_bloom(self, oid: str) -> bytes | None:
+        """
+        Return the changed-path Bloom filter of OID or None if it has none
+        """
+        layer, i = self._layer_of(oid)
+        if layer is None or i is None or layer._blooms_start is None:
+            return None
+        ends = layer._blooms_start
+        start = _EDGE.unpack_from(layer._map, ends + 4 * (i - 1))[0] if i else 0
+        (end,) = _EDGE.unpack_from(layer._map, ends + 4 * i)
+        data_start = ends + 4 * layer.count
+        return layer._map[data_start + start : data_start + end] or None
+
+
+def write_graph(
+    path: str,
+    nodes: dict[str, Node],
+    blooms: dict[str, bytes] | None = None,
+    base: CommitGraph | None = None,
+) -> None:
+    """
+    Write NODES and their changed-path Bloom filters (BLOOMS, which may
+    leave commits out) to a new commit-graph file at PATH, as a layer on
+    top of BASE if given.
+    Every parent must itself be one of the nodes or be in BASE.
+    """
+    blooms = blooms or {}
+    oids = sorted(nodes)
+    offset = base.offset + base.count if base is not None else 0
+    positions = {oid: offset + i for i, oid in enumerate(oids)}
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    records = bytearray()
+    edges: list[int] = []
+    for oid in oids:
+        node = nodes[oid]
+        parents = [_position(parent, positions, base) for parent in node.parents]
+        first = parents[0] if parents else NO_PARENT
+        if len(parents) > 2:
+            second = EXTRA_EDGES | len(edges)
+            edges.extend(parents[1:])
+            edges[-1] |= EXTRA_EDGES
+        else:
+            second = parents[1] if len(parents) == 2 else NO_PARENT
+        records += _RECORD.pack(
+            bytes.fromhex(node.tree), first, second, node.generation
+        )
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), prefix="tmp-", delete=False
+    ) as out:
+        _ = out.write(_HEADER.pack(GRAPH_SIGNATURE, VERSION, len(oids), len(edges)))
+        _ = out.write(_FANOUT.pack(*fanout))
+        _ = out.write(b"".join(bytes.fromhex(oid) for oid in oids))
+        _ = out.write(records)
+        _ = out.write(b"".join(_EDGE.pack(edge) for edge in edges))
+        end = 0
+        for oid in oids:
+            end += len(blooms.get(oid, b""))
+            _ = out.write(_EDGE.pack(end))
+        _ = out.write(b"".join(blooms.get(oid, b"") for oid in oids))
+    os.replace(out.name, path)
+
+
+def _position(oid: str, positions: dict[str, int], base: CommitGraph | None) -> int:
+    position = positions.get(oid)
+    if position is None and base is not None:
+        position = base.position(oid)
+    assert position is not None, f"Parent {oid} is missing from the commit graph"
+    return position
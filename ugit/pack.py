@@ -0,0 +1,650 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from typing import IO
+
+PACK_SIGNATURE = b"UPAK"
+IDX_SIGNATURE = b"UIDX"
+BITMAP_SIGNATURE = b"UBMP"
+VERSION = 1
+
+TYPE_CODES = {"commit": 1, "tree": 2, "blob": 3, "tag": 4}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+DELTA = 7
+
+# Delta search parameters
+WINDOW = 10
+MAX_DEPTH = 10
+MAX_DELTA_SIZE = 1 << 20
+BLOCK = 16
+
+_HEADER = struct.Struct(">4sII")
+_FANOUT = struct.Struct(">256I")
+_OFFSET = struct.Struct(">Q")
+_BITMAP_ENTRY = struct.Struct(">20sI")
+
+
+class Pack:
+    """
+    Read-only view of a pack file and its index, both memory mapped.
+
+    Pack layout:
+        header   "UPAK", version, object count
+        entries  type (1 byte), varint size, varint compressed size,
+                 [base OID (20 bytes) for deltas], zlib data
+        trailer  SHA-1 of everything above
+
+    Index layout:
+        header   "UIDX", version, object count
+        fan-out  256 cumulative counts by first OID byte
+        oids     sorted binary OIDs (20 bytes each)
+        offsets  pack offsets (8 bytes each)
+        trailer  pack checksum
+
+    Bitmap layout (optional):
+        header   "UBMP", version, commit count
+        entries  commit OID (20 bytes), compressed length (4 bytes), zlib
+                 compressed little-endian bitmap where bit i is set if the
+                 object at index position i is reachable from the commit
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path + ".idx", "rb") as f:
+            self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + ".pack", "rb") as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, self.count = _HEADER.unpack_from(self._idx, 0)
+        assert signature == IDX_SIGNATURE, f"Bad index signature in {path}"
+        assert version == VERSION, f"Unsupported index version {version}"
+        self._fanout = _FANOUT.unpack_from(self._idx, _HEADER.size)
+        self._oids_start = _HEADER.size + _FANOUT.size
+        self._offsets_start = self._oids_start + 20 * self.count
+        self._bitmaps: dict[str, int] | None = None
+
+    def close(self) -> None:
+        self._idx.close()
+        self._pack.close()
+
+    def _oid_at(self, i: int) -> bytes:
+        start = self._oids_start + 20 * i
+        return self._idx[start : start + 20]
+
+    def find_offset(self, oid: str) -> int | None:
+        """
+        Look up where OID is stored in the pack
+
+        Args: OID (str)
+        Returns: offset into the pack (int) or None
+        """
+        i = self.position(oid)
+        if i is None:
+            return None
+        return _OFFSET.unpack_from(self._idx, self._offsets_start + 8 * i)[0]
+
+    def position(self, oid: str) -> int | None:
+        """
+        Binary search the index for OID, narrowed by the fan-out table.
+        Positions follow OID order and are what bitmaps are indexed by.
+
+        Args: OID (str)
+        Returns: index position (int) or None
+        """
+        key = bytes.fromhex(oid)
+        lo = self._fanout[key[0] - 1] if key[0] else 0
+        hi = self._fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._oid_at(mid)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def __contains__(self, oid: str) -> bool:
+        return self.find_offset(oid) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self.count):
+            yield self._oid_at(i).hex()
+
+    def iter_prefix(self, prefix: str) -> Iterator[str]:
+        """
+        Yield the OIDs starting with the hex PREFIX in order, found by a
+        binary search for the first OID not below it
+
+        Args: prefix (str)
+        Returns: Iterator[str]
+        """
+        key = bytes.fromhex(prefix.ljust(40, "0"))
+        lo = self._fanout[key[0] - 1] if key[0] else 0
+        hi = self._fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._oid_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for i in range(lo, self.count):
+            oid = self._oid_at(i).hex()
+            if not oid.startswith(prefix):
+                break
+            yield oid
+
+    @property
+    def bitmaps(self) -> dict[str, int]:
+        """
+        Commit OID -> reachability bitmap, empty if the pack has no bitmaps
+        """
+        if self._bitmaps is None:
+            self._bitmaps = _read_bitmaps(self.path + ".bitmap")
+        return self._bitmaps
+
+    def iter_bitmap_oids(self, bits: int) -> Iterator[str]:
+        """
+        Yield the OID of every index position set in BITS
+        """
+        for byte_index, byte in enumerate(
+            bits.to_bytes((self.count + 7) // 8, "little")
+        ):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield self._oid_at(8 * byte_index + bit).hex()
+
+    def read(self, oid: str) -> bytes | None:
+        """
+        Return the raw object (header + content) for OID or None if absent
+        """
+        offset = self.find_offset(oid)
+        if offset is None:
+            return None
+        type_, content = self._read_at(offset)
+        return type_.encode() + b"\x00" + content
+
+    def _read_at(self, offset: int) -> tuple[str, bytes]:
+        return _inflate_at(self._pack, offset, self.find_offset)
+
+
+def _inflate_at(
+    buffer, offset: int, find_offset: Callable[[str], int | None]
+) -> tuple[str, bytes]:
+    """
+    Decode the pack entry at OFFSET in BUFFER, resolving delta chains
+    """
+    code = buffer[offset]
+    pos = offset + 1
+    _, pos = _read_varint(buffer, pos)
+    compressed_size, pos = _read_varint(buffer, pos)
+
+    base_oid = None
+    if code == DELTA:
+        base_oid = buffer[pos : pos + 20].hex()
+        pos += 20
+
+    content = zlib.decompress(buffer[pos : pos + compressed_size])
+    if base_oid is None:
+        return TYPE_NAMES[code], content
+
+    base_offset = find_offset(base_oid)
+    assert base_offset is not None, f"Missing delta base {base_oid}"
+    type_, base = _inflate_at(buffer, base_offset, find_offset)
+    return type_, apply_delta(base, content)
+
+
+def write_pack(
+    pack_dir: str, oids: Iterable[str], read_object: Callable[[str], bytes]
+) -> str | None:
+    """
+    Write every OID into a new pack (plus index) in PACK_DIR.
+    Similar objects of the same type are stored as deltas against each other.
+
+    Args: pack directory (str), OIDs, function returning the raw object for an OID
+    Returns: path of the pack without extension (str) or None if there was nothing to pack
+    """
+    oids = list(oids)
+    if not oids:
+        return None
+
+    os.makedirs(pack_dir, exist_ok=True)
+    with _temporary_pack(pack_dir) as out:
+        offsets, pack_checksum = write_pack_stream(out, oids, read_object)
+
+    path = os.path.join(pack_dir, f"pack-{pack_checksum.hex()}")
+    _write_index(path + ".idx", offsets, pack_checksum)
+    os.replace(out.name, path + ".pack")
+    return path
+
+
+def write_pack_stream(
+    out: IO[bytes],
+    oids: Iterable[str],
+    read_object: Callable[[str], bytes],
+    progress: Callable[[int, int], None] | None = None,
+    window_size: int = WINDOW,
+) -> tuple[dict[str, int], bytes]:
+    """
+    Write a pack holding every OID (including its checksum trailer) to OUT.
+    Similar objects of the same type are stored as deltas against each other,
+    each object is compared to the WINDOW_SIZE objects before it (0 turns
+    delta search off).
+
+    Args: binary file object, OIDs, function returning the raw object for an
+          OID, progress (callable(done, total)) <Optional>, window size (int)
+    Returns: OID -> offset in the pack, pack checksum (bytes)
+    """
+    sizes = []
+    for oid in oids:
+        type_, _, content = read_object(oid).partition(b"\x00")
+        sizes.append((TYPE_CODES[type_.decode()], len(content), oid))
+
+    # Objects of the same type and similar size sit next to each other, so the
+    # sliding window is likely to find a good delta base
+    sizes.sort(key=lambda entry: (entry[0], -entry[1]))
+
+    checksum = hashlib.sha1()
+    offsets: dict[str, int] = {}
+    depths: dict[str, int] = {}
+    window: list[tuple[int, str, bytes]] = []
+
+    def emit(chunk: bytes) -> None:
+        checksum.update(chunk)
+        _ = out.write(chunk)
+
+    emit(_HEADER.pack(PACK_SIGNATURE, VERSION, len(sizes)))
+    position = _HEADER.size
+
+    for done, (code, _, oid) in enumerate(sizes, 1):
+        content = read_object(oid).partition(b"\x00")[2]
+
+        base_oid, delta = _find_delta(code, content, window, depths)
+        if delta is not None and base_oid is not None:
+            entry = bytes([DELTA]) + _encode_varint(len(delta))
+            payload = zlib.compress(delta)
+            entry += _encode_varint(len(payload)) + bytes.fromhex(base_oid)
+            depths[oid] = depths[base_oid] + 1
+        else:
+            entry = bytes([code]) + _encode_varint(len(content))
+            payload = zlib.compress(content)
+            entry += _encode_varint(len(payload))
+            depths[oid] = 0
+
+        offsets[oid] = position
+        emit(entry)
+        emit(payload)
+        position += len(entry) + len(payload)
+        if progress is not None:
+            progress(done, len(sizes))
+
+        if len(content) > MAX_DELTA_SIZE or not window_size:
+            continue
+        window.append((code, oid, content))
+        if len(window) > window_size:
+            window.pop(0)
+
+    pack_checksum = checksum.digest()
+    _ = out.write(pack_checksum)
+    return offsets, pack_checksum
+
+
+def index_pack(
+    pack_dir: str,
+    f: IO[bytes],
+    progress: Callable[[int, int], None] | None = None,
+) -> str | None:
+    """
+    Store the pack stream read from F in PACK_DIR.
+    OIDs are computed and deltas resolved while the stream is copied, so the
+    index is written without reading the pack a second time.
+
+    Args: pack directory (str), binary file object, progress (callable(done, total)) <Optional>
+    Returns: path of the pack without extension (str) or None if it was empty
+    """
+    os.makedirs(pack_dir, exist_ok=True)
+    with _temporary_pack(pack_dir) as out:
+        offsets, pack_checksum = _copy_pack_stream(f, out, progress)
+
+    if not offsets:
+        os.remove(out.name)
+        return None
+
+    path = os.path.join(pack_dir, f"pack-{pack_checksum.hex()}")
+    _write_index(path + ".idx", offsets, pack_checksum)
+    os.replace(out.name, path + ".pack")
+    return path
+
+
+@contextmanager
+def _temporary_pack(pack_dir: str) -> Iterator[IO[bytes]]:
+    """
+    A uniquely named file in PACK_DIR, removed again if writing it fails.
+    Concurrent writers (one thread per push in `ugit serve`) never share it.
+    """
+    with tempfile.NamedTemporaryFile(
+        "w+b", dir=pack_dir, prefix="tmp-", suffix=".pack", delete=False
+    ) as out:
+        try:
+            yield out
+        except BaseException:
+            out.close()
+            os.remove(out.name)
+            raise
+
+
+def _copy_pack_stream(
+    f: IO[bytes], out: IO[bytes], progress: Callable[[int, int], None] | None
+) -> tuple[dict[str, int], bytes]:
+    """
+    Copy the pack stream from F to OUT, computing the OID and offset of
+    every object and checking the trailer
+
+    Returns: OID -> offset in the pack, pack checksum (bytes)
+    """
+    checksum = hashlib.sha1()
+    offsets: dict[str, int] = {}
+    # Delta bases are almost always among the last few objects
+    recent: OrderedDict[str, tuple[str, bytes]] = OrderedDict()
+
+    def read(size: int, hashed: bool = True) -> bytes:
+        chunk = f.read(size)
+        while len(chunk) < size:
+            more = f.read(size - len(chunk))
+            assert more, "Truncated pack stream"
+            chunk += more
+        if hashed:
+            checksum.update(chunk)
+        _ = out.write(chunk)
+        return chunk
+
+    def read_varint() -> int:
+        value = 0
+        shift = 0
+        while True:
+            byte = read(1)[0]
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    signature, version, count = _HEADER.unpack(read(_HEADER.size))
+    assert signature == PACK_SIGNATURE, "Bad pack signature"
+    assert version == VERSION, f"Unsupported pack version {version}"
+
+    for done in range(1, count + 1):
+        offset = out.tell()
+        code = read(1)[0]
+        _ = read_varint()
+        compressed_size = read_varint()
+        base_oid = read(20).hex() if code == DELTA else None
+        content = zlib.decompress(read(compressed_size))
+
+        if base_oid is None:
+            type_ = TYPE_NAMES[code]
+        else:
+            base = recent.get(base_oid)
+            if base is None:
+                out.flush()
+                with mmap.mmap(out.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    base = _inflate_at(buffer, offsets[base_oid], offsets.get)
+            type_, content = base[0], apply_delta(base[1], content)
+
+        oid = hashlib.sha1(type_.encode() + b"\x00" + content).hexdigest()
+        offsets[oid] = offset
+        if len(content) <= MAX_DELTA_SIZE:
+            recent[oid] = (type_, content)
+            if len(recent) > WINDOW:
+                _ = recent.popitem(last=False)
+
+        if progress is not None:
+            progress(done, count)
+
+    pack_checksum = checksum.digest()
+    assert read(20, hashed=False) == pack_checksum, "Pack checksum mismatch"
+    return offsets, pack_checksum
+
+
+def _find_delta(
+    code: int,
+    content: bytes,
+    window: list[tuple[int, str, bytes]],
+    depths: dict[str, int],
+) -> tuple[str | None, bytes | None]:
+    """
+    Pick the candidate from the window that gives the smallest delta for CONTENT
+    """
+    if code not in (TYPE_CODES["blob"], TYPE_CODES["tree"]):
+        return None, None
+    if len(content) > MAX_DELTA_SIZE or len(content) < BLOCK:
+        return None, None
+
+    best_oid = None
+    best_delta = None
+    for base_code, base_oid, base in window:
+        if base_code != code or depths[base_oid] >= MAX_DEPTH:
+            continue
+        # A base less than half the size leaves more than half of CONTENT
+        # to insert, and one over twice the size is rarely a close relative
+        limit = len(best_delta) if best_delta is not None else len(content) // 2
+        if len(content) - len(base) >= limit or len(base) > 2 * len(content):
+            continue
+        delta = create_delta(base, content)
+        if len(delta) < limit:
+            best_oid, best_delta = base_oid, delta
+    return best_oid, best_delta
+
+
+def _write_index(path: str, offsets: dict[str, int], pack_checksum: bytes) -> None:
+    oids = sorted(bytes.fromhex(oid) for oid in offsets)
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[oid[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path), prefix="tmp-", delete=False
+    ) as out:
+        _ = out.write(_HEADER.pack(IDX_SIGNATURE, VERSION, len(oids)))
+        _ = out.write(_FANOUT.pack(*fanout))
+        _ = out.write(b"".join(oids))
+        _ = out.write(b"".join(_OFFSET.pack(offsets[oid.hex()]) for oid in oids))
+        _ = out.write(pack_checksum)
+    os.replace(out.name, path)
+
+
+def write_bitmaps(pack_: Pack, bitmaps: dict[str, int]) -> None:
+    """
+    Store reachability bitmaps for PACK_ next to it
+    """
+    size = (pack_.count + 7) // 8
+    parts = [_HEADER.pack(BITMAP_SIGNATURE, VERSION, len(bitmaps))]
+    for oid in sorted(bitmaps):
+        compressed = zlib.compress(bitmaps[oid].to_bytes(size, "little"))
+        parts.append(_BITMAP_ENTRY.pack(bytes.fromhex(oid), len(compressed)))
+        parts.append(compressed)
+
+    tmp_path = f"{pack_.path}.bitmap.tmp"
+    with open(tmp_path, "wb") as out:
+        _ = out.write(b"".join(parts))
+    os.replace(tmp_path, pack_.path + ".bitmap")
+    pack_._bitmaps = dict(bitmaps)
+
+
+def _read_bitmaps(path: str) -> dict[str, int]:
+    try:
+        with open(path, "rb") as f:
+            buffer = f.read()
+    except FileNotFoundError:
+        return {}
+
+    signature, version, count = _HEADER.unpack_from(buffer, 0)
+    assert signature == BITMAP_SIGNATURE, f"Bad bitmap signature in {path}"
+    assert version == VERSION, f"Unsupported bitmap version {version}"
+    bitmaps = {}
+    pos = _HEADER.size
+    for _ in range(count):
+        oid, length = _BITMAP_ENTRY.unpack_from(buffer, pos)
+        pos += _BITMAP_ENTRY.size
+        compressed = buffer[pos : pos + length]
+        bitmaps[oid.hex()] = int.from_bytes(zlib.decompress(compressed), "little")
+        pos += length
+    return bitmaps
+
+
+def iter_pack_paths(pack_dir: str) -> Iterator[str]:
+    """
+    Yield the path (without extension) of every complete pack in PACK_DIR
+    """
+    if not os.path.isdir(pack_dir):
+        return
+    for name in sorted(os.listdir(pack_dir)):
+        if name.startswith("pack-") and name.endswith(".idx"):
+            path = os.path.join(pack_dir, name[: -len(".idx")])
+            if os.path.isfile(path + ".pack"):
+                yield path
+
+
+def create_delta(base: bytes, target: bytes) -> bytes:
+    """
+    Encode TARGET as copy / insert instructions against BASE.
+
+    Matches are anchored on line starts: every line of TARGET is looked up in
+    a hash of BASE's lines and a hit is extended line by line, so the work is
+    per line rather than per byte. Copies shorter than BLOCK bytes are sent as
+    literals instead.
+
+    Instructions follow git's delta format: a copy opcode has the high bit set
+    and flags for which offset and size bytes follow, an insert opcode is the
+    literal length (1-127) followed by the literal bytes.
+    """
+    base_lines = base.splitlines(keepends=True)
+    base_offsets = [0, *itertools.accumulate(map(len, base_lines))]
+    index: dict[bytes, int] = {}
+    for i, line in enumerate(base_lines):
+        _ = index.setdefault(line, i)
+
+    target_lines = target.splitlines(keepends=True)
+    delta = bytearray(_encode_varint(len(base)) + _encode_varint(len(target)))
+    literal = bytearray()
+    i = 0
+    while i < len(target_lines):
+        j = index.get(target_lines[i])
+        length = 0
+        if j is not None:
+            length = 1
+            while (
+                i + length < len(target_lines)
+                and j + length < len(base_lines)
+                and target_lines[i + length] == base_lines[j + length]
+            ):
+                length += 1
+
+        if j is None or base_offsets[j + length] - base_offsets[j] < BLOCK:
+            literal += target_lines[i]
+            i += 1
+            continue
+
+        _flush_literal(delta, literal)
+        _encode_copy(delta, base_offsets[j], base_offsets[j + length] - base_offsets[j])
+        i += length
+
+    _flush_literal(delta, literal)
+    return bytes(delta)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """
+    Rebuild the target object from BASE and a delta produced by create_delta
+    """
+    base_size, pos = _read_varint(delta, 0)
+    target_size, pos = _read_varint(delta, pos)
+    assert base_size == len(base), "Delta base size mismatch"
+
+    out = bytearray()
+    while pos < len(delta):
+        opcode = delta[pos]
+        pos += 1
+        if opcode & 0x80:
+            offset = 0
+            for shift in range(4):
+                if opcode & (1 << shift):
+                    offset |= delta[pos] << (8 * shift)
+                    pos += 1
+            size = 0
+            for shift in range(3):
+                if opcode & (1 << (4 + shift)):
+                    size |= delta[pos] << (8 * shift)
+                    pos += 1
+            out += base[offset : offset + (size or 0x10000)]
+        else:
+            out += delta[pos : pos + opcode]
+            pos += opcode
+
+    assert len(out) == target_size, "Delta target size mismatch"
+    return bytes(out)
+
+
+def _flush_literal(delta: bytearray, literal: bytearray) -> None:
+    for start in range(0, len(literal), 127):
+        chunk = literal[start : start + 127]
+        delta.append(len(chunk))
+        delta += chunk
+    literal.clear()
+
+
+def _encode_copy(delta: bytearray, offset: int, length: int) -> None:
+    while length:
+        size = min(length, 0xFFFF)
+        opcode = 0x80
+        args = bytearray()
+        for shift in range(4):
+            byte = (offset >> (8 * shift)) & 0xFF
+            if byte:
+                opcode |= 1 << shift
+                args.append(byte)
+        for shift in range(2):
+            byte = (size >> (8 * shift)) & 0xFF
+            if byte:
+                opcode |= 1 << (4 + shift)
+                args.append(byte)
+        delta.append(opcode)
+        delta += args
+        offset += size
+        length -= size
+
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _read_varint(buffer, pos: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
@@ -1,23 +1,131 @@
 from . import data
 from . import base
 
+import contextlib
 import os
+import shutil
+import socket
+import tempfile
+import time
+from typing import IO, NamedTuple
 
 REMOTE_REFS_BASE = os.path.join("refs", "heads")
 LOCAL_REFS_BASE = os.path.join("refs", "remote")
 
+# OID sent in place of a ref that does not exist yet
+ZERO_OID = "0" * 40
 
-def fetch(remote_path: str):
-    heads_path = os.path.join("refs", "heads")
-    refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
 
-    for oid in base.iter_objects_in_commit(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
+class TransferStats(NamedTuple):
+    """
+    Size and duration of one pack transfer
+    """
+
+    objects: int
+    bytes: int
+    seconds: float
+
+
+def fetch(remote_path: str, progress=None, blobs: bool = True) -> TransferStats:
+    """
+    Fetch the remote's branches as one pack holding the objects missing here.
+    Without BLOBS only commits and trees are fetched, and the remote is
+    recorded as the promisor that blobs are fetched from when first read.
+
+    Args: remote path (str), progress (callable(phase, done, total)) <Optional>,
+          blobs (bool)
+    Returns: TransferStats
+    """
+    local_refs = [ref.value for _, ref in data.iter_refs()]
+
+    if parse_url(remote_path) is not None:
+        with _connect(remote_path) as conn:
+            refs = _read_advertisement(conn, REMOTE_REFS_BASE)
+            filters = [] if blobs else ["blob:none"]
+            stats = _fetch_pack(conn, refs.values(), local_refs, progress, filters)
+    else:
+        remote_path = os.path.abspath(remote_path)
+        refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+        with data.change_git_dir(remote_path):
+            objects_to_fetch = base.find_missing_objects(
+                refs.values(), local_refs, blobs
+            )
+        stats = _transfer(remote_path, objects_to_fetch, False, progress)
+
+    if not blobs:
+        data.set_promisor(remote_path)
+    _ = base.update_commit_graph(refs.values())
 
     for remote_name, value in refs.items():
         refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
         local_path = os.path.join(LOCAL_REFS_BASE, refname)
         data.update_ref(local_path, data.RefValue(symbolic=False, value=value))
+    return stats
+
+
+def clone(source: str, directory: str, shared: bool = False) -> int:
+    """
+    Create a repository in DIRECTORY from the local repository SOURCE and
+    check out its current branch.
+    Objects are hardlinked, or with SHARED not copied at all but read
+    through objects/info/alternates, so only refs and the working tree are
+    written.
+
+    Args: source path (str), directory (str), shared (bool)
+    Returns: Number of object files linked (int)
+    """
+    source = os.path.abspath(source)
+    source_objects = os.path.join(source, ".ugit", "objects")
+    assert os.path.isdir(source_objects), f"{source} is not a ugit repository"
+    refs = _get_remote_refs(source, REMOTE_REFS_BASE)
+    with data.change_git_dir(source):
+        head = data.get_ref("HEAD", deref=False)
+
+    cwd = os.getcwd()
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    try:
+        with data.change_git_dir("."):
+            base.init()
+            if shared:
+                data.add_alternate(source_objects)
+                linked = 0
+            else:
+                linked = data.link_objects(source_objects)
+
+            for remote_name, value in refs.items():
+                refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
+                ref = data.RefValue(symbolic=False, value=value)
+                data.update_ref(os.path.join(LOCAL_REFS_BASE, refname), ref)
+                data.update_ref(remote_name, ref)
+
+            if head.symbolic and head.value in refs:
+                data.update_ref("HEAD", head, deref=False)
+                _ = base.read_tree(base.get_commit(refs[head.value]).tree, True)
+            elif head.value:
+                _ = base.checkout(head.value)
+            _ = base.update_commit_graph(refs.values())
+    finally:
+        os.chdir(cwd)
+    return linked
+
+
+def fetch_objects(remote_path: str, oids, progress=None) -> TransferStats:
+    """
+    Fetch exactly OIDS (typically blobs left out by a partial fetch) as one
+    pack. Objects the remote does not have are skipped.
+
+    Args: remote path (str), OIDs, progress (callable(phase, done, total)) <Optional>
+    Returns: TransferStats
+    """
+    if parse_url(remote_path) is not None:
+        with _connect(remote_path) as conn:
+            _ = _read_advertisement(conn)
+            return _fetch_pack(conn, oids, [], progress, command="objects")
+
+    with data.change_git_dir(remote_path):
+        available = [oid for oid in oids if data.object_exists(oid)]
+    return _transfer(remote_path, available, False, progress)
 
 
 def _get_remote_refs(remote_path: str, prefix: str = ""):
@@ -25,21 +133,178 @@ def _get_remote_refs(remote_path: str, prefix: str = ""):
         return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
 
 
-def push(remote_path: str, refname: str):
-    remote_refs = _get_remote_refs(remote_path)
-    remote_ref = remote_refs.get(refname)
+def push(remote_path: str, refname: str, progress=None) -> TransferStats:
+    """
+    Push REFNAME as one pack holding the objects the remote is missing
+
+    Args: remote path (str), ref name (str), progress (callable(phase, done, total)) <Optional>
+    Returns: TransferStats
+    """
     local_ref = data.get_ref(refname).value
     assert local_ref
 
-    assert not remote_ref or base.is_ancestor_of(local_ref, remote_ref)
+    if parse_url(remote_path) is not None:
+        with _connect(remote_path) as conn:
+            remote_refs = _read_advertisement(conn)
+            return _push_pack(conn, refname, local_ref, remote_refs, progress)
 
-    known_remote_refs = filter(data.object_exists, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_commit(known_remote_refs))
-    local_objects = set(base.iter_objects_in_commit({local_ref}))
-    objects_to_push = local_objects - remote_objects
+    remote_refs = _get_remote_refs(remote_path)
+    remote_ref = remote_refs.get(refname)
+    assert not remote_ref or base.is_ancestor_of(local_ref, remote_ref)
 
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    objects_to_push = base.find_missing_objects([local_ref], remote_refs.values())
+    stats = _transfer(remote_path, objects_to_push, True, progress)
 
     with data.change_git_dir(remote_path):
         data.update_ref(refname, data.RefValue(symbolic=False, value=local_ref))
+    return stats
+
+
+def _transfer(remote_path: str, oids, to_remote: bool, progress=None) -> TransferStats:
+    """
+    Pack OIDS in one repository and index the stream in the other,
+    from here to REMOTE_PATH if TO_REMOTE is set, otherwise the other way
+    """
+    if not oids:
+        return TransferStats(0, 0, 0.0)
+
+    local = contextlib.nullcontext()
+    remote = data.change_git_dir(remote_path)
+    source, destination = (local, remote) if to_remote else (remote, local)
+
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as stream:
+        with source:
+            data.send_pack(stream, oids, _report(progress, "Compressing objects"))
+        size = stream.tell()
+        _ = stream.seek(0)
+        with destination:
+            _ = data.receive_pack(stream, _report(progress, "Indexing objects"))
+    return TransferStats(len(oids), size, time.perf_counter() - start)
+
+
+def _report(progress, phase: str):
+    if progress is None:
+        return None
+    return lambda done, total: progress(phase, done, total)
+
+
+def parse_url(url: str):
+    """
+    Split a `ugit serve` address into its socket family and address.
+    Supported forms are unix:<path> and tcp://<host>:<port>.
+
+    Args: url (str)
+    Returns: ("unix", path) or ("tcp", (host, port)), None for a repository path
+    """
+    if url.startswith("unix:"):
+        return "unix", url[len("unix:") :]
+    if url.startswith("tcp://"):
+        host, _, port = url[len("tcp://") :].rpartition(":")
+        return "tcp", (host, int(port))
+    return None
+
+
+@contextlib.contextmanager
+def _connect(url: str):
+    """
+    Yield a buffered binary file object talking to a `ugit serve` process
+    """
+    family, address = parse_url(url)
+    if family == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address)
+
+    with sock, sock.makefile("rwb") as conn:
+        yield conn
+
+
+def _read_line(conn: IO[bytes]) -> str:
+    line = conn.readline()
+    assert line.endswith(b"\n"), "Connection closed by the server"
+    line = line[:-1].decode()
+    assert not line.startswith("error "), line[len("error ") :]
+    return line
+
+
+def _read_advertisement(conn: IO[bytes], prefix: str = "") -> dict[str, str]:
+    """
+    Read the "<oid> <ref>" lines the server starts every connection with
+    """
+    refs = {}
+    while line := _read_line(conn):
+        oid, refname = line.split(" ", 1)
+        if refname.startswith(prefix):
+            refs[refname] = oid
+    return refs
+
+
+def _fetch_pack(
+    conn: IO[bytes], wants, haves, progress=None, filters=(), command="fetch"
+) -> TransferStats:
+    """
+    Ask the server for WANTS, listing HAVES as commits it can leave out, and
+    index the pack it sends back straight from the socket.
+    The "fetch" command wants commits and everything they reach (minus
+    object types named in FILTERS), "objects" wants exactly the given objects.
+    """
+    start = time.perf_counter()
+    lines = [command]
+    lines.extend(f"want {oid}" for oid in wants)
+    lines.extend(f"have {oid}" for oid in haves if oid)
+    lines.extend(f"filter {name}" for name in filters)
+    lines.append("done")
+    _ = conn.write("".join(f"{line}\n" for line in lines).encode())
+    conn.flush()
+
+    # The server acknowledges the haves it shares with us, then sends the pack
+    while (line := _read_line(conn)).startswith("ack "):
+        pass
+    header, count, size = line.split(" ")
+    assert header == "pack", f"Unexpected reply {line}"
+    if int(count):
+        _ = data.receive_pack(conn, _report(progress, "Receiving objects"))
+    return TransferStats(int(count), int(size), time.perf_counter() - start)
+
+
+def _push_pack(
+    conn: IO[bytes], refname: str, new: str, remote_refs: dict[str, str], progress
+) -> TransferStats:
+    """
+    Send REFNAME's update and the objects the server is missing, then wait
+    for the server to accept it
+    """
+    # Ref names travel with "/" separators whatever the local OS uses
+    refname = refname.replace(os.sep, "/")
+    old = remote_refs.get(refname)
+    assert not old or base.is_ancestor_of(new, old)
+
+    start = time.perf_counter()
+    objects_to_push = base.find_missing_objects([new], remote_refs.values())
+    _ = conn.write(f"push\nupdate {old or ZERO_OID} {new} {refname}\n".encode())
+    size = _send_pack_frame(conn, objects_to_push, progress)
+    conn.flush()
+
+    reply = _read_line(conn)
+    refused = reply.removeprefix(f"ng {refname} ")
+    assert refused == reply, f"Push of {refname} refused: {refused}"
+    assert reply == f"ok {refname}", f"Unexpected reply {reply}"
+    return TransferStats(len(objects_to_push), size, time.perf_counter() - start)
+
+
+def _send_pack_frame(conn: IO[bytes], oids, progress=None) -> int:
+    """
+    Write "pack <count> <size>" followed by a pack of OIDS
+
+    Returns: size of the pack in bytes (int)
+    """
+    with tempfile.TemporaryFile() as stream:
+        if oids:
+            data.send_pack(stream, oids, _report(progress, "Compressing objects"))
+        size = stream.tell()
+        _ = conn.write(f"pack {len(oids)} {size}\n".encode())
+        _ = stream.seek(0)
+        shutil.copyfileobj(stream, conn, data.CHUNK_SIZE)
+    return size
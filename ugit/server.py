@@ -0,0 +1,200 @@
+import asyncio
+import functools
+import string
+import tempfile
+
+from . import base
+from . import data
+from . import remote
+
+# Protocol spoken by `ugit serve`, one request per connection, all lines
+# newline terminated:
+#
+#     server  "<oid> <ref>" for every ref, then an empty line
+#     client  "fetch", "want <oid>"..., "have <oid>"...,
+#             ["filter blob:none"], "done"
+#     server  "ack <oid>" for every have it also has,
+#             "pack <count> <size>" and the pack
+#
+#     client  "objects", "want <oid>"..., "done"
+#     server  "pack <count> <size>" and a pack of the wanted objects it has
+#
+#     client  "push", "update <old> <new> <ref>",
+#             "pack <count> <size>" and the pack
+#     server  "ok <ref>", or "ng <ref> <reason>" if the update was refused
+#
+# Any request can be answered with "error <message>" instead.
+
+
+def serve(url: str) -> None:
+    """
+    Serve the current repository on URL (unix:<path> or tcp://<host>:<port>)
+    until interrupted
+
+    Args: url (str)
+    Returns: None
+    """
+    asyncio.run(_serve(url))
+
+
+async def _serve(url: str) -> None:
+    parsed = remote.parse_url(url)
+    assert parsed, f"Cannot serve on {url}, use unix:<path> or tcp://<host>:<port>"
+    family, address = parsed
+
+    # Pushes to the same repository update refs one at a time
+    handler = functools.partial(_handle, asyncio.Lock())
+    if family == "unix":
+        server = await asyncio.start_unix_server(handler, path=address)
+    else:
+        server = await asyncio.start_server(handler, *address)
+
+    async with server:
+        await server.serve_forever()
+
+
+async def _handle(
+    ref_lock: asyncio.Lock, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """
+    Answer one client connection. Object enumeration, packing and indexing
+    run on worker threads so other clients are served in the meantime.
+    """
+    try:
+        refs = await asyncio.to_thread(_list_refs)
+        lines = [f"{oid} {refname}\n" for refname, oid in refs.items()]
+        writer.write("".join(lines).encode() + b"\n")
+        await writer.drain()
+
+        command = await _read_line(reader)
+        if command in ("fetch", "objects"):
+            await _upload_pack(reader, writer, command)
+        elif command == "push":
+            await _receive_pack(reader, writer, ref_lock)
+        else:
+            writer.write(f"error Unknown command {command}\n".encode())
+    except (AssertionError, FileNotFoundError, ValueError) as e:
+        writer.write(f"error {e}\n".encode())
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+    try:
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+    except ConnectionError:
+        pass
+
+
+def _list_refs() -> dict[str, str]:
+    return {refname: ref.value for refname, ref in data.iter_refs()}
+
+
+async def _read_line(reader: asyncio.StreamReader) -> str:
+    line = await reader.readline()
+    assert line.endswith(b"\n"), "Connection closed by the client"
+    return line[:-1].decode()
+
+
+async def _upload_pack(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, command: str
+) -> None:
+    wants: list[str] = []
+    haves: list[str] = []
+    filters: list[str] = []
+    while (line := await _read_line(reader)) != "done":
+        kind, value = line.split(" ", 1)
+        assert kind in ("want", "have", "filter"), f"Unexpected line {line}"
+        {"want": wants, "have": haves, "filter": filters}[kind].append(value)
+    assert set(filters) <= {"blob:none"}, f"Unsupported filter {filters}"
+
+    if command == "objects":
+        oids = await asyncio.to_thread(lambda: list(filter(data.object_exists, wants)))
+    else:
+        common = await asyncio.to_thread(
+            lambda: list(filter(data.object_exists, haves))
+        )
+        writer.write("".join(f"ack {oid}\n" for oid in common).encode())
+        blobs = "blob:none" not in filters
+        oids = await asyncio.to_thread(base.find_missing_objects, wants, common, blobs)
+    with tempfile.TemporaryFile() as stream:
+        if oids:
+            await asyncio.to_thread(data.send_pack, stream, oids)
+        size = stream.tell()
+        writer.write(f"pack {len(oids)} {size}\n".encode())
+        _ = stream.seek(0)
+        while chunk := stream.read(data.CHUNK_SIZE):
+            writer.write(chunk)
+            await writer.drain()
+
+
+async def _receive_pack(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, ref_lock: asyncio.Lock
+) -> None:
+    kind, old, new, refname = (await _read_line(reader)).split(" ")
+    if kind != "update":
+        raise ValueError(f"Unexpected line {kind}")
+    # A refused update still gets its pack read, but never indexed
+    refused = _check_update(refname, old, new)
+
+    kind, count, size = (await _read_line(reader)).split(" ")
+    if kind != "pack":
+        raise ValueError(f"Unexpected line {kind}")
+    with tempfile.TemporaryFile() as stream:
+        remaining = int(size)
+        while remaining:
+            chunk = await reader.read(min(remaining, data.CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError("Connection closed by the client")
+            _ = stream.write(chunk)
+            remaining -= len(chunk)
+        _ = stream.seek(0)
+        if int(count) and refused is None:
+            _ = await asyncio.to_thread(data.receive_pack, stream)
+
+    if refused is None:
+        async with ref_lock:
+            refused = await asyncio.to_thread(_update_ref, refname, old, new)
+    if refused is not None:
+        writer.write(f"ng {refname} {refused}\n".encode())
+    else:
+        writer.write(f"ok {refname}\n".encode())
+
+
+def _check_update(refname: str, old: str, new: str) -> str | None:
+    """
+    Reason to refuse a pushed update line before reading its pack, None if
+    it names a branch and well-formed OIDs. Anything else could write
+    arbitrary files under the repository directory.
+    """
+    parts = refname.split("/")
+    if parts[:2] != ["refs", "heads"] or len(parts) < 3:
+        return "only branches under refs/heads/ can be pushed"
+    if any(part in ("", ".", "..") or "\\" in part for part in parts):
+        return f"invalid ref name {refname}"
+    for oid in (old, new):
+        if len(oid) != 40 or not all(c in string.hexdigits for c in oid):
+            return f"invalid OID {oid}"
+    if new == remote.ZERO_OID:
+        return "deleting refs is not supported"
+    return None
+
+
+def _update_ref(refname: str, old: str, new: str) -> str | None:
+    """
+    Move REFNAME from OLD to NEW if nobody moved it in the meantime and the
+    update is a fast-forward
+
+    Returns: reason the update was refused, None once it is done
+    """
+    current = data.get_ref(refname).value
+    expected = None if old == remote.ZERO_OID else old
+    if current != expected:
+        return f"{refname} changed on the server, fetch first"
+    if not data.object_exists(new):
+        return f"missing objects for {new}"
+    if current and not base.is_ancestor_of(new, current):
+        return "not a fast-forward"
+    data.update_ref(refname, data.RefValue(symbolic=False, value=new))
+    _ = base.update_commit_graph([new])
+    return None